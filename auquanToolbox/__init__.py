@@ -1,7 +1,13 @@
 try:
     from .dataloader import *
     from .toolbox import *
-    from .resultviewer import *
     from .metrics import *
+    from .drawdowns import *
+    from .result import *
+    from .timing import *
+    from .resultfile import *
+    from .resultcache import *
+    from .tradingcalendar import *
+    from .sweeps import *
 except:
     raise
@@ -0,0 +1,282 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import numpy as np
+import pandas as pd
+import json
+import os
+import shutil
+import tempfile
+
+# The cache for an exchange lives in <exchange>/cache/:
+#   current             - name of the version directory in use
+#   <version>/data.npy  - float64 array of shape (features, tickers, dates), NaN where a ticker has no row
+#   <version>/dates.npy - int64 nanosecond timestamps of the union of all ticker dates, ascending
+#   <version>/meta.json - tickers, features of all tickers, and the columns, csv mtime and first/last row of every ticker
+# An update writes a new version directory and swaps it in by replacing current in a single rename,
+# so readers always see the three files of one version together.
+
+
+def read_market_csv(exchange, market):
+    ''' reads <exchange>/historicalData/<market>.csv
+    Returns:
+        DataFrame with a DatetimeIndex in ascending order and upper case feature columns
+    '''
+    csv = pd.read_csv(csv_path(exchange, market), index_col=0)
+    csv.index = pd.to_datetime(csv.index)
+    csv.columns = [col.upper() for col in csv.columns]
+    return csv.reindex(index=csv.index[::-1])
+
+
+def csv_path(exchange, market):
+    return '%s/historicalData/%s.csv' % (exchange.lower(), market.lower())
+
+
+def cache_dir(exchange):
+    return '%s/cache/' % exchange.lower()
+
+
+def load_cache(exchange):
+    ''' opens the cache of an exchange
+    Returns:
+        (meta, dates, data) with data memory mapped read-only, or None if there is no usable cache
+    '''
+    dir_name = cache_dir(exchange)
+    # an update can remove the version just read from current, the second try reads the new one
+    for attempt in range(2):
+        try:
+            with open(dir_name + 'current') as f:
+                version_dir = dir_name + f.read().strip() + '/'
+            with open(version_dir + 'meta.json') as f:
+                meta = json.load(f)
+            dates = np.load(version_dir + 'dates.npy')
+            data = np.load(version_dir + 'data.npy', mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            continue
+        if list(data.shape) != [len(meta['features']), len(meta['tickers']), dates.size]:
+            return None
+        return meta, dates, data
+    return None
+
+
+def stale_markets(meta, exchange, markets):
+    ''' markets whose csv is not in the cache or changed since it was cached '''
+    if meta is None:
+        return list(markets)
+    stale = []
+    for market in markets:
+        # caches written before the columns of every ticker were stored are read again
+        if market not in meta['mtimes'] or market not in meta.get('columns', {}) or \
+                meta['mtimes'][market] != os.path.getmtime(csv_path(exchange, market)):
+            stale.append(market)
+    return stale
+
+
+def update_cache(exchange, markets, logger):
+    ''' adds markets to the cache of an exchange, re-reading any csv that changed since it was cached
+    Returns:
+        (meta, dates, data) as load_cache
+    '''
+    cached = load_cache(exchange)
+    meta = cached[0] if cached is not None else None
+    stale = stale_markets(meta, exchange, markets)
+    if len(stale) == 0:
+        return cached
+
+    logger.info('Updating cache for %s' % exchange)
+    csvs = {}
+    for market in stale:
+        logger.info('Reading %s.csv' % market)
+        csvs[market] = read_market_csv(exchange, market)
+
+    if cached is None:
+        (meta, old_dates, old_data) = ({'tickers': [], 'features': [], 'columns': {}, 'mtimes': {}, 'first': {}, 'last': {}},
+                                       np.array([], dtype=np.int64), None)
+    else:
+        (meta, old_dates, old_data) = cached
+        meta.setdefault('columns', {})
+
+    tickers = meta['tickers'] + [m for m in stale if m not in meta['tickers']]
+    features = list(meta['features'])
+    for csv in csvs.values():
+        features += [col for col in csv.columns if col not in features]
+    dates = old_dates
+    for csv in csvs.values():
+        dates = np.union1d(dates, csv.index.values.astype(np.int64))
+
+    data = np.full((len(features), len(tickers), dates.size), np.nan)
+    if old_data is not None:
+        rows = np.searchsorted(dates, old_dates)
+        for i, feature in enumerate(meta['features']):
+            data[features.index(feature), :len(meta['tickers'])][:, rows] = old_data[i]
+    for market, csv in csvs.items():
+        j = tickers.index(market)
+        rows = np.searchsorted(dates, csv.index.values.astype(np.int64))
+        data[:, j] = np.nan
+        for feature in csv.columns:
+            data[features.index(feature), j, rows] = csv[feature].values
+        meta['columns'][market] = list(csv.columns)
+        meta['mtimes'][market] = os.path.getmtime(csv_path(exchange, market))
+        meta['first'][market] = int(rows[0])
+        meta['last'][market] = int(rows[-1])
+    if old_data is not None:
+        # row positions move when new dates are added
+        remap = np.searchsorted(dates, old_dates)
+        for market in meta['tickers']:
+            if market not in csvs:
+                meta['first'][market] = int(remap[meta['first'][market]])
+                meta['last'][market] = int(remap[meta['last'][market]])
+    meta['tickers'] = tickers
+    meta['features'] = features
+
+    write_cache(exchange, meta, dates, data)
+    return load_cache(exchange)
+
+
+def write_cache(exchange, meta, dates, data):
+    dir_name = cache_dir(exchange)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    # a new version directory, so an interrupted run never leaves a half written cache
+    # and readers of the current version are not disturbed
+    version_dir = tempfile.mkdtemp(prefix='v-', dir=dir_name)
+    np.save(os.path.join(version_dir, 'dates.npy'), dates)
+    np.save(os.path.join(version_dir, 'data.npy'), data)
+    with open(os.path.join(version_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    old_version = None
+    if os.path.exists(dir_name + 'current'):
+        with open(dir_name + 'current') as f:
+            old_version = f.read().strip()
+    tmp_name = '%scurrent.%d.part' % (dir_name, os.getpid())
+    with open(tmp_name, 'w') as f:
+        f.write(os.path.basename(version_dir))
+    replace_file(tmp_name, dir_name + 'current')
+
+    # open memory maps of the old version stay valid, where files in use cannot be removed they are left behind
+    if old_version and old_version != os.path.basename(version_dir):
+        shutil.rmtree(dir_name + old_version, ignore_errors=True)
+
+
+def replace_file(src, dst):
+    ''' renames src to dst in one step, replacing dst '''
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # Python 2, rename replaces dst atomically on POSIX
+        os.rename(src, dst)
+
+
+def cached_market_data(exchange, markets, logger):
+    ''' reads markets through the on-disk cache, updating it first if any csv is new or changed
+    Returns:
+        dict of market -> DataFrame in the same layout as read_market_csv, with the columns of its own csv
+    '''
+    (meta, dates, data) = update_cache(exchange, markets, logger)
+    index = pd.DatetimeIndex(dates.view('datetime64[ns]'))
+    market_data = {}
+    for market in markets:
+        j = meta['tickers'].index(market)
+        rows = slice(meta['first'][market], meta['last'][market] + 1)
+        columns = meta['columns'][market]
+        feature_index = [meta['features'].index(f) for f in columns]
+        market_data[market] = pd.DataFrame(data[feature_index, j, rows].T, index=index[rows], columns=columns)
+    return market_data
+
+
+class CachedFrame(object):
+    ''' one feature of markets on a date range, left in the memory mapped cache of an exchange
+
+    Slicing rows, frame[a:b] or frame.iloc[a:b], reads only those rows from the cache into a
+    DataFrame, values reads all of them. A market that stopped trading repeats its last row,
+    as align_market does. Built by load_data with stream=True.
+    '''
+    ndim = 2
+
+    def __init__(self, data, tickers, rows, last, index, columns, dtype=np.float64):
+        # data is the (tickers, dates) array of the feature in the cache, rows the cache row of
+        # every date of index and last the last cache row of every market
+        self._data = data
+        self._tickers = tickers
+        self._rows = rows
+        self._last = last
+        self.index = index
+        self.columns = pd.Index(columns)
+        self.dtype = dtype
+
+    @property
+    def iloc(self):
+        return self
+
+    @property
+    def shape(self):
+        return (self.index.size, self.columns.size)
+
+    @property
+    def values(self):
+        return self[:].values
+
+    def __len__(self):
+        return self.index.size
+
+    def __getitem__(self, rows):
+        (start, stop, step) = rows.indices(self.index.size)
+        cache_rows = np.minimum(self._rows[start:stop:step, None], self._last[None, :])
+        values = np.asarray(self._data[self._tickers[None, :], cache_rows], dtype=self.dtype)
+        return pd.DataFrame(values, index=self.index[start:stop:step], columns=self.columns)
+
+
+def stream_cached_markets(exchange, markets, date_range, first_date, logger, compact=False):
+    ''' aligns markets to date_range as align_market does, reading the cache one market at a time
+    instead of building a DataFrame of every market
+    Returns:
+        (aligned, date_range, back_data): aligned holds (reason, back_fill_data, None) per market as
+        align_market, date_range leaves out the dates a market has no data on, and back_data has a
+        CachedFrame per feature over the markets kept
+    '''
+    (meta, dates, data) = update_cache(exchange, markets, logger)
+
+    stamps = date_range.asi8
+    positions = np.minimum(np.searchsorted(dates, stamps), max(dates.size - 1, 0))
+    found = dates[positions] == stamps if dates.size > 0 else np.zeros(stamps.size, dtype=bool)
+    first_date = pd.to_datetime(first_date).value
+
+    aligned = []
+    tickers = []
+    last = []
+    for market in markets:
+        (first_row, last_row) = (meta['first'][market], meta['last'][market])
+        if dates[first_row] > first_date:
+            aligned.append(('This stock did not start trading before (start date -lookback days)', False, None))
+            continue
+        if dates[last_row] < first_date:
+            aligned.append(('This stock terminated before (start date -lookback days)', False, None))
+            continue
+        aligned.append((None, bool((stamps == dates[last_row]).any()), None))
+        tickers.append(meta['tickers'].index(market))
+        last.append(last_row)
+
+    # the features of the markets kept, as load_data takes them from their csv files
+    kept = [m for m, (reason, back_fill_data, csv) in zip(markets, aligned) if reason is None]
+    features = ['OPEN', 'CLOSE', 'HIGH', 'LOW', 'VOLUME']
+    for market in kept:
+        features += [f for f in meta['columns'][market] if f not in features]
+    features = [f for f in features if f in meta['features']]
+    feature_index = [meta['features'].index(f) for f in features]
+
+    dates_to_drop = np.zeros(stamps.size, dtype=bool)
+    for j, last_row in zip(tickers, last):
+        # a date the market traded on needs a full row, later dates repeat its last row.
+        # A feature missing from its csv is NaN in the cache and drops every date, as it does without the cache
+        trading = stamps <= dates[last_row]
+        rows = np.minimum(positions, last_row)
+        values = data[:, j, rows][feature_index]
+        dates_to_drop |= (trading & ~found) | np.isnan(values).any(axis=0)
+
+    date_range = date_range[~dates_to_drop]
+    tickers = np.array(tickers, dtype=np.int64)
+    last = np.array(last, dtype=np.int64)
+    back_data = {}
+    for feature, i in zip(features, feature_index):
+        back_data[feature] = CachedFrame(data[i], tickers, positions[~dates_to_drop], last, date_range, kept,
+                                         np.float32 if compact else np.float64)
+    return aligned, date_range, back_data
@@ -1,61 +1,54 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
-try:
-    from urllib2 import urlopen
-except ImportError:
-    from urllib.request import urlopen
 import numpy as np
 import pandas as pd
 from pandas.tseries.offsets import BDay
+from pandas.tseries.frequencies import to_offset
 import os
+import logging
+from multiprocessing import Pool
+from auquanToolbox.datacache import read_market_csv, cached_market_data, stream_cached_markets
+from auquanToolbox.downloader import fetch, data_url, write_atomic, bulk_download
+from auquanToolbox.engine import DAILY, bar_end
 
+# aggregation of the rows of a csv into longer bars, last value for any other feature
+BAR_AGGREGATION = {'OPEN': 'first', 'HIGH': 'max', 'LOW': 'min', 'CLOSE': 'last', 'VOLUME': 'sum'}
 
-def download(exchange, ticker, file_name, logger):
-    url = 'https://raw.githubusercontent.com/Auquan/auquan-historical-data/master/%s/historicalData/%s.csv' % (
-        exchange.lower(), ticker.lower())
-    response = urlopen(url)
-    status = response.getcode()
-    if status == 200:
+
+def download(exchange, ticker, file_name, logger, base_url=None):
+    content = fetch(data_url('%s/historicalData/%s.csv' % (exchange.lower(), ticker.lower()), base_url))
+    if content is not None:
         logger.info('Downloading %s data to file: %s' % (ticker, file_name))
-        with open(file_name, 'w') as f:
-            f.write(response.read())
+        write_atomic(file_name, content)
         return True
     else:
         logger.info('File not found. Please check settings!')
         return False
 
 
-def data_available(exchange, markets, logger):
+def data_available(exchange, markets, logger, workers=8, base_url=None):
     dir_name = '%s/historicalData/' % exchange.lower()
-    if not os.path.exists(dir_name):
-        os.makedirs(dir_name)
-    for m in markets:
-        file_name = '%s%s.csv' % (dir_name, m.lower())
-        if not os.path.exists(file_name):
-            try:
-                assert(download(exchange, m, file_name, logger)
-                       ), "%s not found. Please check settings!" % file_name
-            except AssertionError:
-                logger.exception(
-                    "%s not found. Please check settings!" % file_name)
-                raise
+    not_found = bulk_download(exchange, markets, logger, workers=workers, base_url=base_url)
+    file_name = ', '.join('%s%s.csv' % (dir_name, m.lower()) for m in not_found)
+    try:
+        assert(len(not_found) == 0), "%s not found. Please check settings!" % file_name
+    except AssertionError:
+        logger.exception(
+            "%s not found. Please check settings!" % file_name)
+        raise
     return True
 
 
-def download_security_list(exchange, logger):
+def download_security_list(exchange, logger, base_url=None):
     dir_name = '%s/' % exchange.lower()
     if not os.path.exists(dir_name):
         os.makedirs(dir_name)
 
     file_name = '%s%s.txt' % (dir_name, exchange.lower())
     if not os.path.exists(file_name):
-        url = 'https://raw.githubusercontent.com/Auquan/auquan-historical-data/master/%s' % (
-            file_name)
-        response = urlopen(url)
-        status = response.getcode()
-        if status == 200:
+        content = fetch(data_url(file_name, base_url))
+        if content is not None:
             logger.info('Downloading data to file: %s' % file_name)
-            with open(file_name, 'w') as f:
-                f.write(response.read())
+            write_atomic(file_name, content)
             return True
         else:
             logger.info('File not found. Please check exchange settings!')
@@ -71,14 +64,103 @@ def compatibleDictKeyCheck(dict, key):
         return key in dict
 
 
-def load_data(exchange, markets, start, end, lookback, budget, logger, random=False):
+def align_market(csv, date_range, first_date):
+    ''' aligns the data of one market to date_range
+    Returns:
+        (reason, back_fill_data, aligned) where reason says why the market has to be dropped, or is None.
+        aligned is a float64 DataFrame indexed by date_range, with the last known data
+        carried forward if the market stopped trading within date_range
+    '''
+    market_first_date = csv.index[0]
+    if (market_first_date > first_date):
+        return 'This stock did not start trading before (start date -lookback days)', False, None
+    market_last_date = csv.index[-1]
+    if (market_last_date < first_date):
+        return 'This stock terminated before (start date -lookback days)', False, None
+
+    aligned = csv.reindex(index=date_range).astype(float)
+    back_fill_data = market_last_date in date_range
+    if back_fill_data:
+        aligned.loc[market_last_date:] = aligned.loc[market_last_date].values
+    return None, back_fill_data, aligned
+
+
+def read_and_align_market(task):
+    # runs in the worker processes of load_data, so it takes a single picklable argument
+    (exchange, market, date_range, first_date) = task
+    return align_market(read_market_csv(exchange, market), date_range, first_date)
+
+
+def resample_bars(csv, freq):
+    ''' csv as bars of freq, rows within the same bar aggregated by BAR_AGGREGATION.
+    Bars without any row are left out, and a csv with no more than one row per bar is returned unchanged,
+    so data already at freq keeps its own timestamps
+    '''
+    rows = csv.iloc[:, 0].resample(freq).size()
+    if (rows.values > 0).sum() == len(csv):
+        return csv
+    bars = csv.resample(freq).agg(dict((col, BAR_AGGREGATION.get(col, 'last')) for col in csv.columns))
+    return bars[rows.values > 0]
+
+
+def read_market_bars(task):
+    # runs in the worker processes of load_data, so it takes a single picklable argument
+    (exchange, market, freq) = task
+    return resample_bars(read_market_csv(exchange, market), freq)
+
+
+def bar_range(market_data, start, end, cushion):
+    ''' union of the bars of all markets up to end, starting cushion bars before the first bar at or after start '''
+    bars = [csv.index.asi8 for csv in market_data]
+    bars = np.unique(np.concatenate(bars)) if len(bars) > 0 else np.array([], dtype=np.int64)
+    bars = pd.DatetimeIndex(bars.view('datetime64[ns]'))
+    bars = bars[:bars.searchsorted(end, side='right')]
+    return bars[max(bars.searchsorted(start) - cushion, 0):]
+
+
+def init_state(back_data, date_range, markets, budget, compact=False):
+    # state written by the backtest loop, before the first trade
+    shares = np.int32 if compact else np.int64
+    back_data['COST TO TRADE'] = pd.DataFrame(
+        0, index=date_range, columns=markets)
+    back_data['POSITION'] = pd.DataFrame(0, index=date_range, columns=markets, dtype=shares)
+    back_data['ORDER'] = pd.DataFrame(0, index=date_range, columns=markets, dtype=shares)
+    back_data['FILLED_ORDER'] = pd.DataFrame(
+        0, index=date_range, columns=markets, dtype=shares)
+    back_data['DAILY_PNL'] = pd.DataFrame(0, index=date_range, columns=markets)
+    back_data['TOTAL_PNL'] = pd.DataFrame(0, index=date_range, columns=markets)
+    back_data['FUNDS'] = pd.Series(budget, index=date_range)
+    back_data['VALUE'] = pd.Series(budget, index=date_range)
+    back_data['MARGIN'] = pd.Series(0, index=date_range)
+
+
+def load_data(exchange, markets, start, end, lookback, budget, logger, random=False, use_cache=False, workers=1, compact=False, freq=DAILY, state=True, stream=False):
+    ''' market data of markets between start and end, with lookback dates before start
+    compact stores market data as float32 and share counts as int32, halving the memory they take.
+    Without state, back_data holds no POSITION, FUNDS... frames. The numpy engine allocates its own state,
+    the pandas engine adds them when they are missing.
+    With use_cache and stream, daily market data stays in the memory mapped cache: every feature is
+    a CachedFrame that only reads the rows it is sliced for, as run_backtest with chunk_size does.
+    freq is the length of a bar, business days by default. With any other pandas frequency
+    such as 'H' or '5min', the bars are the timestamps found in the csv files, rows of a csv
+    finer than freq being aggregated into bars of freq, and an end without a time of day
+    includes all the bars of that day.
+    Returns:
+        (back_data, date_range)
+    '''
 
     logger.info("Loading Data from %s to %s...." % (start, end))
 
     # because there are some holidays adding some cushion to lookback
+    cushion = int(lookback * 1.10) + 10
     try:
-        dates = [pd.to_datetime(
-            start) - BDay((lookback * 1.10) + 10), pd.to_datetime(end)]
+        if freq == DAILY:
+            dates = [pd.to_datetime(start) - BDay(cushion), pd.to_datetime(end)]
+        elif random:
+            dates = [pd.to_datetime(start) - cushion * to_offset(freq), bar_end(end, freq)]
+        else:
+            # the cushion is counted in bars once the data is read
+            dates = [pd.to_datetime(start), bar_end(end, freq)]
     except ValueError:
         logger.exception(
             "%s or %s is not valid date. Please check settings!" % (start, end))
@@ -91,8 +173,9 @@ def load_data(exchange, markets, start, end, lookback, budget, logger, random=Fa
         logger.exception("Start Date is after End Date")
         raise
 
-    # Download list of securities
-    assert(download_security_list(exchange, logger))
+    # Download list of securities, random data for given markets works offline
+    if not random or len(markets) == 0:
+        assert(download_security_list(exchange, logger))
     if len(markets) == 0:
         file_name = '%s/%s.txt' % (exchange.lower(), exchange.lower())
 
@@ -100,81 +183,94 @@ def load_data(exchange, markets, start, end, lookback, budget, logger, random=Fa
 
     markets = [m.upper() for m in markets]
     features = ['OPEN', 'CLOSE', 'HIGH', 'LOW', 'VOLUME']
-    date_range = pd.date_range(start=dates[0], end=dates[1], freq='B')
+    if freq == DAILY or random:
+        date_range = pd.date_range(start=dates[0], end=dates[1], freq=freq)
     back_data = {}
     if random:
         for feature in features:
             back_data[feature] = pd.DataFrame(np.random.randint(10, 50, size=(date_range.size, len(markets))),
                                               index=date_range,
-                                              columns=markets)
+                                              columns=markets, dtype=np.float32 if compact else None)
     else:
-        for feature in features:
-            back_data[feature] = pd.DataFrame(
-                index=date_range, columns=markets)
         assert data_available(exchange, markets, logger)
+        first_date = dates[0] - BDay(1) + BDay(1)
+        if freq != DAILY:
+            # the dates are only known once every csv is read
+            if use_cache:
+                market_data = cached_market_data(exchange, markets, logger)
+                market_data = [resample_bars(market_data[market], freq) for market in markets]
+            elif workers > 1:
+                pool = Pool(workers)
+                try:
+                    market_data = pool.map(read_market_bars, [(exchange, market, freq) for market in markets])
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                market_data = [read_market_bars((exchange, market, freq)) for market in markets]
+            date_range = bar_range(market_data, dates[0], dates[1], cushion)
+            first_date = date_range[0] if date_range.size > 0 else dates[0]
+            aligned = [align_market(csv, date_range, first_date) for csv in market_data]
+        elif use_cache and stream:
+            (aligned, date_range, frames) = stream_cached_markets(exchange, markets, date_range, first_date, logger, compact)
+        elif use_cache:
+            market_data = cached_market_data(exchange, markets, logger)
+            aligned = [align_market(market_data[market], date_range, first_date) for market in markets]
+        else:
+            tasks = [(exchange, market, date_range, first_date) for market in markets]
+            if workers > 1:
+                pool = Pool(workers)
+                try:
+                    aligned = pool.map(read_and_align_market, tasks, chunksize=max(1, len(tasks) // (4 * workers)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                aligned = [read_and_align_market(task) for task in tasks]
+
         market_to_drop = []
-        for market in markets:
-            logger.info('Reading %s.csv' % market)
-            csv = pd.read_csv('%s/historicalData/%s.csv' %
-                              (exchange.lower(), market.lower()), index_col=0)
-            csv.index = pd.to_datetime(csv.index)
-            csv.columns = [col.upper() for col in csv.columns]
-            csv = csv.reindex(index=csv.index[::-1])
-            features = [col.upper() for col in csv.columns]
-            market_first_date = csv.index[0]
-            if (market_first_date > (dates[0] - BDay(1) + BDay(1))):
-                market_to_drop.append(market)
-                logger.info(
-                    'Dropping %s. This stock did not start trading before (start date -lookback days)' % market)
-                continue
-            market_last_date = csv.index[-1]
-            if (market_last_date < (dates[0] - BDay(1) + BDay(1))):
+        for market, (reason, back_fill_data, csv) in zip(markets, aligned):
+            if not use_cache:
+                logger.info('Reading %s.csv' % market)
+            if reason is not None:
                 market_to_drop.append(market)
-                logger.info(
-                    'Dropping %s. This stock terminated before (start date -lookback days)' % market)
-                continue
-
-            back_fill_data = False
-            if market_last_date in date_range:
-                back_fill_data = True
+                logger.info('Dropping %s. %s' % (market, reason))
+            elif back_fill_data:
                 logger.info(
                     'The market %s doesnt have data for the whole duration. Subsituting missing dates with the last known data' % market)
 
-            for feature in features:
-                if not compatibleDictKeyCheck(back_data, feature):
-                    back_data[feature] = pd.DataFrame(
-                        index=date_range, columns=markets)
-                back_data[feature][market] = csv[feature][date_range]
-                if back_fill_data:
-                    back_data[feature].loc[market_last_date:date_range[-1],
-                                           market] = back_data[feature].at[market_last_date, market]
-
         for m in market_to_drop:
             logger.info('Dropping %s. Not Enough Data' % m)
             markets.remove(m)
 
-        for feature in features:
-            back_data[feature].drop(market_to_drop, axis=1, inplace=True)
-        dates_to_drop = pd.Series(False, index=date_range)
-        for feature in features:
-            dates_to_drop |= pd.isnull(back_data[feature]).any(axis=1)
+        if use_cache and stream and freq == DAILY:
+            # the dates without data are already left out
+            back_data.update(frames)
+        else:
+            aligned = [csv for (reason, back_fill_data, csv) in aligned if reason is None]
+            for csv in aligned:
+                features += [col for col in csv.columns if col not in features]
+            if len(aligned) > 0:
+                # one concatenation for all markets, columns are (market, feature)
+                dtype = np.float32 if compact else np.float64
+                all_data = pd.concat([csv.reindex(columns=features).astype(dtype) for csv in aligned], axis=1, keys=markets)
+                for feature in features:
+                    back_data[feature] = all_data.xs(feature, axis=1, level=1)
+            else:
+                for feature in features:
+                    back_data[feature] = pd.DataFrame(index=date_range, columns=markets, dtype=np.float32 if compact else float)
 
-        dropped_dates = date_range[dates_to_drop]
-        date_range = date_range[~dates_to_drop]
-        for feature in features:
-            back_data[feature] = back_data[feature].drop(dropped_dates)
+            dates_to_drop = pd.Series(False, index=date_range)
+            for feature in features:
+                dates_to_drop |= pd.isnull(back_data[feature]).any(axis=1)
 
-    back_data['COST TO TRADE'] = pd.DataFrame(
-        0, index=date_range, columns=markets)
-    back_data['POSITION'] = pd.DataFrame(0, index=date_range, columns=markets)
-    back_data['ORDER'] = pd.DataFrame(0, index=date_range, columns=markets)
-    back_data['FILLED_ORDER'] = pd.DataFrame(
-        0, index=date_range, columns=markets)
-    back_data['DAILY_PNL'] = pd.DataFrame(0, index=date_range, columns=markets)
-    back_data['TOTAL_PNL'] = pd.DataFrame(0, index=date_range, columns=markets)
-    back_data['FUNDS'] = pd.Series(budget, index=date_range)
-    back_data['VALUE'] = pd.Series(budget, index=date_range)
-    back_data['MARGIN'] = pd.Series(0, index=date_range)
+            dropped_dates = date_range[dates_to_drop]
+            date_range = date_range[~dates_to_drop]
+            for feature in features:
+                back_data[feature] = back_data[feature].drop(dropped_dates)
+
+    if state:
+        init_state(back_data, date_range, markets, budget, compact)
 
     return back_data, date_range
 
@@ -186,28 +282,16 @@ def load_data_nologs(exchange, markets, start, end, lookback=2):
     # because there are some holidays adding some cushion to lookback
     try:
         dates = [pd.to_datetime(
-            start) - BDay(lookback * 1.10), pd.to_datetime(end)]
+            start) - BDay(int(lookback * 1.10)), pd.to_datetime(end)]
     except ValueError:
         raise ValueError(
             "%s or %s is not valid date. Please check settings!" % (start, end))
 
     assert(dates[1] > dates[0]), "Start Date is after End Date"
 
-    dir_name = '%s/' % exchange.lower()
-    if not os.path.exists(dir_name):
-        os.makedirs(dir_name)
-
-    file_name = '%s%s.txt' % (dir_name, exchange.lower())
-    if not os.path.exists(file_name):
-        url = 'https://raw.githubusercontent.com/Auquan/auquan-historical-data/master/%s' % (
-            file_name)
-        response = urlopen(url)
-        status = response.getcode()
-        if status == 200:
-            with open(file_name, 'w') as f:
-                f.write(response.read())
-        else:
-            print('File not found. Please check exchange name!')
+    logger = logging.getLogger(__name__)
+    if not download_security_list(exchange, logger):
+        print('File not found. Please check exchange name!')
 
     if len(markets) == 0:
         file_name = '%s/%s.txt' % (exchange.lower(), exchange.lower())
@@ -220,21 +304,8 @@ def load_data_nologs(exchange, markets, start, end, lookback=2):
     back_data = {}
     for feature in features:
         back_data[feature] = pd.DataFrame(index=date_range, columns=markets)
-    dir_name = '%s/historicalData/' % exchange.lower()
-    if not os.path.exists(dir_name):
-        os.makedirs(dir_name)
-    for m in markets:
-        file_name = '%s%s.csv' % (dir_name, m.lower())
-        if not os.path.exists(file_name):
-            url = 'https://raw.githubusercontent.com/Auquan/auquan-historical-data/master/%s/historicalData/%s.csv' % (
-                exchange.lower(), m.lower())
-            response = urlopen(url)
-            status = response.getcode()
-            if status == 200:
-                with open(file_name, 'w') as f:
-                    f.write(response.read())
-            else:
-                print('File not found. Please check settings!')
+    for m in bulk_download(exchange, markets, logger):
+        print('File not found. Please check settings!')
 
     market_to_drop = []
     for market in markets:
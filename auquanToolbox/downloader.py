@@ -0,0 +1,108 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+try:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit
+except ImportError:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import tempfile
+import threading
+import time
+from auquanToolbox.datacache import replace_file
+
+# where exchange lists and historical data are downloaded from. Can be pointed
+# to a mirror, or to a local http server for testing
+BASE_URL = 'https://raw.githubusercontent.com/Auquan/auquan-historical-data/master/'
+
+_connections = threading.local()
+
+
+def data_url(path, base_url=None):
+    if base_url is None:
+        base_url = BASE_URL
+    return base_url.rstrip('/') + '/' + path
+
+
+def fetch(url, retries=3, backoff=0.5, timeout=30):
+    ''' downloads url over a connection kept open per thread and per host
+    Returns:
+        the response body, or None if the server answered 404
+    Retries with exponential backoff on connection errors and any status other than 200 and 404
+    '''
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    if not hasattr(_connections, 'open'):
+        _connections.open = {}
+
+    for attempt in range(retries + 1):
+        connection = _connections.open.get(key)
+        if connection is None:
+            connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+            connection = connection_class(parts.netloc, timeout=timeout)
+            _connections.open[key] = connection
+        try:
+            connection.request('GET', path, headers={'Connection': 'keep-alive'})
+            response = connection.getresponse()
+            body = response.read()
+            if response.status == 200:
+                return body
+            if response.status == 404:
+                return None
+            error = IOError('%s returned status %d' % (url, response.status))
+        except (HTTPException, socket.error) as e:
+            error = e
+            connection.close()
+            del _connections.open[key]
+        if attempt < retries:
+            time.sleep(backoff * 2 ** attempt)
+    raise error
+
+
+def write_atomic(file_name, content):
+    ''' writes content next to file_name and renames it into place, so readers never see a partial file '''
+    # a name of its own, downloads of the same file at once don't write into each other's
+    (fd, tmp_name) = tempfile.mkstemp(prefix=os.path.basename(file_name) + '.', suffix='.part',
+                                      dir=os.path.dirname(file_name) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        replace_file(tmp_name, file_name)
+    except Exception:
+        os.remove(tmp_name)
+        raise
+
+
+def bulk_download(exchange, tickers, logger, workers=8, retries=3, backoff=0.5, base_url=None):
+    ''' downloads the historical data of all tickers that are not on disk yet
+    Files already present are skipped, so an interrupted download resumes where it stopped.
+    Returns:
+        list of tickers the server does not have
+    '''
+    dir_name = '%s/historicalData/' % exchange.lower()
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    missing = [t for t in tickers if not os.path.exists('%s%s.csv' % (dir_name, t.lower()))]
+
+    def download_one(ticker):
+        file_name = '%s%s.csv' % (dir_name, ticker.lower())
+        content = fetch(data_url('%s/historicalData/%s.csv' % (exchange.lower(), ticker.lower()), base_url),
+                        retries, backoff)
+        if content is None:
+            return ticker
+        logger.info('Downloading %s data to file: %s' % (ticker, file_name))
+        write_atomic(file_name, content)
+        return None
+
+    if len(missing) == 0:
+        return []
+    pool = ThreadPool(min(workers, len(missing)))
+    try:
+        not_found = pool.map(download_one, missing)
+    finally:
+        pool.close()
+        pool.join()
+    return [t for t in not_found if t is not None]
@@ -0,0 +1,67 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import numpy as np
+import pandas as pd
+
+__all__ = ['drawdown', 'drawdown_stats']
+
+
+def drawdown(equity, relative=False):
+    ''' drawdown of an equity curve such as TOTAL_PNL or VALUE, for every column at once
+    Args:
+        equity: DataFrame of one equity curve per column, or a single Series
+        relative: measure drawdowns as a fraction of the peak instead of in equity units
+    Returns:
+        distance below the highest equity reached so far, shaped like equity
+    '''
+    values = np.asarray(equity, dtype=float)
+    peak = np.maximum.accumulate(values, axis=0)
+    depth = peak - values
+    if relative:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            depth = np.where(peak != 0, depth / np.abs(peak), 0)
+    if isinstance(equity, pd.Series):
+        return pd.Series(depth, index=equity.index)
+    return pd.DataFrame(depth, index=equity.index, columns=equity.columns)
+
+
+def drawdown_stats(equity, relative=False):
+    ''' deepest drawdown of every equity curve, with its dates and durations
+    Returns:
+        DataFrame with a row per column of equity (a Series for a Series) holding
+        Max Drawdown, Start (last peak before it), Trough, Recovery (first date back at the peak,
+        NaT if still under water), and the Decline, Recovery and Total lengths in dates
+    '''
+    is_series = isinstance(equity, pd.Series)
+    frame = equity.to_frame() if is_series else equity
+    values = frame.values.astype(float)
+    (n, m) = values.shape
+    depth = drawdown(frame, relative).values
+
+    positions = np.arange(n).reshape(-1, 1)
+    peak = np.maximum.accumulate(values, axis=0)
+    # position of the peak every date is measured from
+    peak_position = np.maximum.accumulate(np.where(values >= peak, positions, 0), axis=0)
+
+    columns = np.arange(m)
+    trough = np.argmax(depth, axis=0)
+    max_drawdown = depth[trough, columns]
+    start = peak_position[trough, columns]
+    recovered = (positions > trough) & (values >= peak[trough, columns])
+    has_recovered = recovered.any(axis=0)
+    recovery = np.where(has_recovered, np.argmax(recovered, axis=0), -1)
+
+    in_drawdown = max_drawdown > 0
+    index = frame.index
+    stats = pd.DataFrame({
+        'Max Drawdown': max_drawdown,
+        'Start': index[start].where(in_drawdown),
+        'Trough': index[trough].where(in_drawdown),
+        'Recovery': index[recovery].where(in_drawdown & has_recovered),
+        'Decline Days': np.where(in_drawdown, trough - start, 0),
+        'Recovery Days': np.where(in_drawdown, np.where(has_recovered, recovery - trough, np.nan), 0),
+        'Total Days': np.where(in_drawdown, np.where(has_recovered, recovery - start, np.nan), 0)},
+        index=frame.columns,
+        columns=['Max Drawdown', 'Start', 'Trough', 'Recovery', 'Decline Days', 'Recovery Days', 'Total Days'])
+    if is_series:
+        return stats.iloc[0]
+    return stats
@@ -0,0 +1,139 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import sys
+import numpy as np
+import pandas as pd
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# features written by the backtest loop, one column per market
+MARKET_STATE = ['COST TO TRADE', 'POSITION', 'ORDER', 'FILLED_ORDER', 'DAILY_PNL', 'TOTAL_PNL']
+# features written by the backtest loop, one value per date
+PORTFOLIO_STATE = ['FUNDS', 'VALUE', 'MARGIN']
+# state that holds share counts
+INT_STATE = ['POSITION', 'ORDER', 'FILLED_ORDER']
+# daily bars on business days, the default frequency. Any other pandas frequency, such as 'H' or '5min',
+# takes its bars from the timestamps in the data instead of a calendar
+DAILY = 'B'
+
+
+def to_arrays(back_data, compact=False):
+    ''' converts back_data as returned by load_data into contiguous numpy arrays
+    Returns:
+        dict of feature -> array of shape (dates, markets), or (dates,) for portfolio state.
+        Share counts are stored as int64, everything else as float64.
+        With compact, share counts are int32 and market data float32, money stays float64.
+        State arrays are always copies. Market data is only copied when it is not
+        already contiguous in its dtype, so it may share memory with back_data, it is never written to
+    '''
+    arrays = {}
+    for feature, data in back_data.items():
+        if feature in MARKET_STATE or feature in PORTFOLIO_STATE:
+            if feature in INT_STATE:
+                dtype = np.int32 if compact else np.int64
+            else:
+                dtype = np.float64
+            arrays[feature] = np.array(data.values, dtype=dtype, order='C')
+        else:
+            arrays[feature] = np.ascontiguousarray(data.values, dtype=np.float32 if compact else np.float64)
+    return arrays
+
+
+def state_arrays(dates, markets, budget, compact=False):
+    ''' the state the numpy engine writes, as it is before the first trade: no positions or pnl and all of
+    budget available. Share counts are int64, int32 with compact, everything else float64
+    '''
+    arrays = {}
+    for feature in MARKET_STATE:
+        if feature in INT_STATE:
+            dtype = np.int32 if compact else np.int64
+        else:
+            dtype = np.float64
+        arrays[feature] = np.zeros((dates, markets), dtype=dtype)
+    arrays['FUNDS'] = np.full(dates, budget, dtype=np.float64)
+    arrays['VALUE'] = np.full(dates, budget, dtype=np.float64)
+    arrays['MARGIN'] = np.zeros(dates)
+    return arrays
+
+
+def peak_memory():
+    ''' peak resident memory of this process in MB, None where the resource module is missing (Windows) '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def bar_end(date_end, freq=DAILY):
+    ''' last time traded up to date_end. A date without a time of day includes all its bars when freq is not daily '''
+    date_end = pd.to_datetime(date_end)
+    if freq != DAILY and date_end == date_end.normalize():
+        date_end += pd.Timedelta(days=1) - pd.Timedelta(1)
+    return date_end
+
+
+def to_frames(arrays, date_range, markets):
+    ''' wraps arrays built by to_arrays back into the pandas objects load_data returns '''
+    back_data = {}
+    for feature, data in arrays.items():
+        if data.ndim == 1:
+            back_data[feature] = pd.Series(data, index=date_range)
+        else:
+            back_data[feature] = pd.DataFrame(data, index=date_range, columns=markets)
+    return back_data
+
+
+class LookbackData(Mapping):
+    ''' lookback window handed to trading_strategy by the numpy engine
+
+    Behaves like the lookback_data dict of the pandas engine, but holds read-only
+    numpy views into the backtest arrays, so building it costs the same whatever
+    the lookback and only the features a strategy reads are ever sliced.
+    With raw=False lookback_data[feature] is a pandas object built on first access,
+    with raw=True it is the numpy view itself. frame(feature) and array(feature)
+    give either form regardless of the mode.
+    '''
+
+    def __init__(self, arrays, date_range, markets, start, end, raw=False):
+        self._arrays = arrays
+        self._date_range = date_range
+        self._start = start
+        self._end = end
+        self._raw = raw
+        self._frames = {}
+        self.markets = markets
+
+    @property
+    def dates(self):
+        return self._date_range[self._start:self._end]
+
+    def array(self, feature):
+        view = self._arrays[feature][self._start:self._end]
+        view.flags.writeable = False
+        return view
+
+    def frame(self, feature):
+        if feature not in self._frames:
+            data = self.array(feature)
+            if data.ndim == 1:
+                self._frames[feature] = pd.Series(data, index=self.dates)
+            else:
+                self._frames[feature] = pd.DataFrame(data, index=self.dates, columns=self.markets)
+        return self._frames[feature]
+
+    def __getitem__(self, feature):
+        if self._raw:
+            return self.array(feature)
+        return self.frame(feature)
+
+    def __iter__(self):
+        return iter(self._arrays)
+
+    def __len__(self):
+        return len(self._arrays)
@@ -1,74 +1,107 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 import numpy as np
 import pandas as pd
-from auquanToolbox.dataloader import data_available
-import matplotlib.pyplot as plt
-
-
-def metrics(daily_pnl, total_pnl, baseline_data, base_index):
-
+import os
+from pandas.tseries.frequencies import to_offset
+from auquanToolbox.dataloader import data_available, resample_bars
+from auquanToolbox.datacache import read_market_csv
+from auquanToolbox.drawdowns import drawdown
+from auquanToolbox.engine import DAILY
+
+# memoized results of baseline and baseline_csv
+_baseline_cache = {}
+_baseline_csv = {}
+
+# bars in a year of daily data, and the length of the trading session intraday bars are counted over
+TRADING_DAYS = 252
+TRADING_SESSION = pd.Timedelta(hours=6.5)
+
+
+def periods_per_year(freq=DAILY):
+    ''' number of bars of freq in a year, that returns and volatility are annualized over '''
+    if freq == DAILY:
+        return TRADING_DAYS
+    offset = to_offset(freq)
+    try:
+        bar = pd.Timedelta(offset.nanos)
+    except ValueError:
+        # no fixed length, such as 'W' or 'M'
+        return len(pd.date_range('2001-01-01', '2001-12-31', freq=offset))
+    if bar < pd.Timedelta(days=1):
+        return TRADING_DAYS * (TRADING_SESSION / bar)
+    return TRADING_DAYS / (bar / pd.Timedelta(days=1))
+
+
+def metrics(daily_pnl, total_pnl, baseline_data, base_index, freq=DAILY):
+    ''' stats of a backtest, daily_pnl and total_pnl being fractions of the budget.
+    With freq other than daily the returns are per bar of freq, annualized over periods_per_year(freq)
+    '''
     stats = {}
     daily_return = daily_pnl.sum(axis=1)
+    periods = periods_per_year(freq)
 
     stats['Total Pnl'] = (total_pnl.iloc[total_pnl.index.size - 1].sum())
-    stats['Annual Return'] = annualized_return(daily_return)
-    stats['Annual Vol'] = annual_vol(daily_return)
-    stats['Sharpe Ratio'] = sharpe_ratio(daily_return)
-    stats['Sortino Ratio'] = sortino_ratio(daily_return)
+    stats['Annual Return'] = annualized_return(daily_return, periods)
+    stats['Annual Vol'] = annual_vol(daily_return, periods)
+    stats['Sharpe Ratio'] = sharpe_ratio(daily_return, periods)
+    stats['Sortino Ratio'] = sortino_ratio(daily_return, periods)
     stats['Max Drawdown'] = max_drawdown(daily_return)
     stats['Profit Factor'] = profit_factor(daily_return)
     stats['Profitablity (%)'] = profit_percent(daily_return)
     if base_index:
-        stats['Base Return(%)'] = annualized_return(baseline_data['DAILY_PNL'])
+        stats['Base Return(%)'] = annualized_return(baseline_data['DAILY_PNL'], periods)
         stats['Beta'] = beta(daily_return, baseline_data['DAILY_PNL'])
 
-    for x in stats.keys():
+    for x in list(stats.keys()):
         if np.isnan(stats[x]):
             del stats[x]
 
     return stats
 
 
-def annualized_return(daily_return):
-    total_return = daily_return.sum()
-    total_days = daily_return.index.size
+def annualized_return(daily_return, periods=TRADING_DAYS):
+    return _annualize(daily_return.sum(), daily_return.index.size, periods)
+
+
+def _annualize(total_return, total_days, periods=TRADING_DAYS):
     if total_return < -1:
         total_return = -1
-    return ((1 + total_return)**(252 / total_days) - 1)
+    return ((1 + total_return)**(periods / total_days) - 1)
 
 
-def annualized_std(daily_return):
-    return np.sqrt(252) * np.std(daily_return)
+def annualized_std(daily_return, periods=TRADING_DAYS):
+    return np.sqrt(periods) * np.std(daily_return)
 
 
-def annualized_downside_std(daily_return):
+def annualized_downside_std(daily_return, periods=TRADING_DAYS):
     downside_return = daily_return.copy()
     downside_return[downside_return > 0] = 0
-    return np.sqrt(252) * np.std(downside_return)
+    return np.sqrt(periods) * np.std(downside_return)
 
 
-def annual_vol(daily_return):
-    return annualized_std(daily_return)
+def annual_vol(daily_return, periods=TRADING_DAYS):
+    return annualized_std(daily_return, periods)
 
 
-def sharpe_ratio(daily_return):
-    stdev = annualized_std(daily_return)
+def sharpe_ratio(daily_return, periods=TRADING_DAYS):
+    stdev = annualized_std(daily_return, periods)
     if stdev == 0:
         return np.nan
     else:
-        return annualized_return(daily_return) / stdev
+        return annualized_return(daily_return, periods) / stdev
 
 
-def sortino_ratio(daily_return):
-    stdev = annualized_downside_std(daily_return)
+def sortino_ratio(daily_return, periods=TRADING_DAYS):
+    stdev = annualized_downside_std(daily_return, periods)
     if stdev == 0:
         return np.nan
     else:
-        return annualized_return(daily_return) / stdev
+        return annualized_return(daily_return, periods) / stdev
 
 
 def max_drawdown(daily_return):
-    return np.max(np.maximum.accumulate(daily_return) - daily_return)
+    # measured on the cumulative return, not on the daily returns themselves
+    return np.max(drawdown(daily_return.cumsum()))
 
 
 def beta(daily_return, baseline_daily_return):
@@ -79,8 +112,8 @@ def beta(daily_return, baseline_daily_return):
         return np.corrcoef(daily_return, baseline_daily_return)[0, 1] * np.std(daily_return) / stdev
 
 
-def alpha(daily_return, baseline_daily_return, beta):
-    return annualized_return(daily_return) - beta * annualized_return(baseline_daily_return)
+def alpha(daily_return, baseline_daily_return, beta, periods=TRADING_DAYS):
+    return annualized_return(daily_return, periods) - beta * annualized_return(baseline_daily_return, periods)
 
 
 def profit_factor(daily_return):
@@ -104,41 +137,224 @@ def profit_percent(daily_return):
     return upside_return.sum() / total_return.sum()
 
 
-def baseline(exchange, base_index, date_range, logger):
-    features = ['OPEN', 'CLOSE']
+def rolling_metrics(daily_return, window, baseline_daily_return=None, freq=DAILY):
+    ''' stats over a trailing window of daily returns, computed in one pass from cumulative sums
+    Args:
+        daily_return: DataFrame of daily returns per market (or a single Series)
+        window: number of dates in each window
+        baseline_daily_return: daily returns of the base index, adds Rolling Beta
+        freq: bar length of the returns, annualized over periods_per_year(freq)
+    Returns:
+        dict of 'Rolling Vol', 'Rolling Sharpe', 'Rolling Drawdown' and 'Rolling Beta' to data shaped
+        like daily_return, NaN for the first window - 1 dates. Drawdown is measured from the highest
+        cumulative return of the window, the other stats match the functions above on the window
+    '''
+    is_series = isinstance(daily_return, pd.Series)
+    frame = daily_return.to_frame() if is_series else daily_return
+    values = frame.values.astype(float)
+
+    window_sum = _window_sum(values, window)
+    mean = window_sum / window
+    var = np.maximum(_window_sum(values * values, window) / window - mean * mean, 0)
+    periods = periods_per_year(freq)
+    vol = np.sqrt(periods) * np.sqrt(var)
+    annual_return = (1 + np.maximum(window_sum, -1))**(periods / window) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(vol > 0, annual_return / vol, np.nan)
+
+    total_return = pd.DataFrame(np.cumsum(values, axis=0), index=frame.index, columns=frame.columns)
+    drawdown = total_return.rolling(window).max() - total_return
+
+    rolling = {'Rolling Vol': vol, 'Rolling Sharpe': sharpe, 'Rolling Drawdown': drawdown.values}
+    if baseline_daily_return is not None:
+        base = np.asarray(baseline_daily_return, dtype=float).reshape(-1, 1)
+        base_mean = _window_sum(base, window) / window
+        base_var = np.maximum(_window_sum(base * base, window) / window - base_mean * base_mean, 0)
+        cov = _window_sum(values * base, window) / window - mean * base_mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rolling['Rolling Beta'] = np.where((base_var > 0) & (var > 0), cov / base_var, np.nan)
+
+    for x in rolling:
+        rolling[x] = pd.DataFrame(rolling[x], index=frame.index, columns=frame.columns)
+        if is_series:
+            rolling[x] = rolling[x].iloc[:, 0]
+    return rolling
+
+
+def _window_sum(values, window):
+    # sum over the trailing window of every row, NaN until a full window is available
+    cumulative = np.cumsum(values, axis=0)
+    sums = np.full(cumulative.shape, np.nan)
+    if window <= len(values):
+        sums[window - 1] = cumulative[window - 1]
+        sums[window:] = cumulative[window:] - cumulative[:-window]
+    return sums
+
+
+class OnlineMetrics(object):
+    ''' the stats of metrics, updated in O(1) for every new daily return
+
+    Feed it the portfolio daily return (daily pnl / budget) of each date, and optionally
+    the daily return of the base index, in order. stats() gives the same result as metrics
+    over all returns seen so far, and every stat is also available on its own.
+    With freq other than daily the returns are per bar, as in metrics.
+    '''
+
+    def __init__(self, freq=DAILY):
+        self.periods = periods_per_year(freq)
+        self.days = 0
+        self.total_return = 0.0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._downside_mean = 0.0
+        self._downside_m2 = 0.0
+        self._peak = -np.inf
+        self._max_drawdown = 0.0
+        self._gains = 0.0
+        self._losses = 0.0
+        self._up_days = 0
+        self._traded_days = 0
+        self.base_days = 0
+        self.base_total_return = 0.0
+        self._base_mean = 0.0
+        self._base_m2 = 0.0
+        self._co_moment = 0.0
+
+    def update(self, daily_return, base_return=None):
+        self.days += 1
+        self.total_return += daily_return
+        delta = daily_return - self._mean
+        self._mean += delta / self.days
+        self._m2 += delta * (daily_return - self._mean)
+
+        downside = min(daily_return, 0)
+        downside_delta = downside - self._downside_mean
+        self._downside_mean += downside_delta / self.days
+        self._downside_m2 += downside_delta * (downside - self._downside_mean)
+
+        self._peak = max(self._peak, self.total_return)
+        self._max_drawdown = max(self._max_drawdown, self._peak - self.total_return)
+
+        if daily_return > 0:
+            self._gains += daily_return
+            self._up_days += 1
+        elif daily_return < 0:
+            self._losses += daily_return
+        if daily_return != 0:
+            self._traded_days += 1
+
+        if base_return is not None:
+            self.base_days += 1
+            self.base_total_return += base_return
+            base_delta = base_return - self._base_mean
+            self._base_mean += base_delta / self.base_days
+            self._base_m2 += base_delta * (base_return - self._base_mean)
+            # the strategy mean was already updated for this date
+            self._co_moment += base_delta * (daily_return - self._mean)
+
+    def annualized_return(self):
+        return _annualize(self.total_return, self.days, self.periods)
+
+    def annual_vol(self):
+        return np.sqrt(self.periods) * np.sqrt(self._m2 / self.days)
+
+    def sharpe_ratio(self):
+        stdev = self.annual_vol()
+        if stdev == 0:
+            return np.nan
+        return self.annualized_return() / stdev
+
+    def sortino_ratio(self):
+        stdev = np.sqrt(self.periods) * np.sqrt(self._downside_m2 / self.days)
+        if stdev == 0:
+            return np.nan
+        return self.annualized_return() / stdev
+
+    def max_drawdown(self):
+        return self._max_drawdown
+
+    def profit_factor(self):
+        if self._losses == 0:
+            return 0
+        return -self._gains / self._losses
+
+    def profit_percent(self):
+        if self._traded_days == 0:
+            return 0
+        return self._up_days / self._traded_days
+
+    def beta(self):
+        if self._base_m2 == 0 or self._m2 == 0:
+            return np.nan
+        return self._co_moment / self._base_m2
+
+    def stats(self):
+        stats = {}
+        stats['Total Pnl'] = self.total_return
+        stats['Annual Return'] = self.annualized_return()
+        stats['Annual Vol'] = self.annual_vol()
+        stats['Sharpe Ratio'] = self.sharpe_ratio()
+        stats['Sortino Ratio'] = self.sortino_ratio()
+        stats['Max Drawdown'] = self.max_drawdown()
+        stats['Profit Factor'] = self.profit_factor()
+        stats['Profitablity (%)'] = self.profit_percent()
+        if self.base_days > 0:
+            stats['Base Return(%)'] = _annualize(self.base_total_return, self.base_days, self.periods)
+            stats['Beta'] = self.beta()
+
+        for x in list(stats.keys()):
+            if np.isnan(stats[x]):
+                del stats[x]
+
+        return stats
+
+
+def baseline(exchange, base_index, date_range, logger, freq=DAILY):
+    ''' pnl of holding base_index over date_range, relative to its open on the first trading date
+    With freq other than daily the base index is aggregated into bars of freq first, as load_data does for markets.
+    Results are memoized per exchange, base_index, date_range and freq, and the csv is only read
+    again when it changes on disk.
+    '''
+    key = (exchange.lower(), base_index.lower(), date_range.asi8.tobytes(), freq)
+    csv = baseline_csv(exchange, base_index, logger)
+    if key in _baseline_cache and _baseline_cache[key][0] is csv:
+        return dict(_baseline_cache[key][1])
+
+    bars = csv if freq == DAILY else resample_bars(csv, freq)
     baseline_data = {}
-
-    assert data_available(exchange, [base_index], logger)
-    csv = pd.read_csv('%s/historicalData/%s.csv' %
-                      (exchange.lower(), base_index.lower()), index_col=0)
-    csv.index = pd.to_datetime(csv.index)
-    csv.columns = [col.upper() for col in csv.columns]
-    csv = csv.reindex(index=csv.index[::-1])
-    # features = [col.upper() for col in csv.columns]
-
-    for feature in features:
-        baseline_data[feature] = pd.Series(0, index=date_range)
-        baseline_data[feature][base_index] = csv[feature][date_range]
-
-    baseline_data['DAILY_PNL'] = pd.Series(0, index=date_range)
-    baseline_data['TOTAL_PNL'] = pd.Series(0, index=date_range)
-
-    open_start = baseline_data['OPEN'][base_index].iloc[1]
-    for end in range(1, date_range.size):
-        close_curr = baseline_data['CLOSE'][base_index].iloc[end]
-        close_last = baseline_data['CLOSE'][base_index].iloc[end - 1]
-        if end == 1:
-            close_last = open_start
-        pnl_curr = (close_curr - close_last) / open_start
-
-        baseline_data['DAILY_PNL'].iloc[end] = pnl_curr
-        baseline_data['TOTAL_PNL'].iloc[end] = pnl_curr + \
-            baseline_data['TOTAL_PNL'].iloc[end - 1]
-
-    return baseline_data
+    for feature in ['OPEN', 'CLOSE']:
+        baseline_data[feature] = bars[feature].reindex(date_range)
+
+    close = baseline_data['CLOSE'].values.astype(float)
+    daily_pnl = np.zeros(date_range.size)
+    if date_range.size > 1:
+        open_start = float(baseline_data['OPEN'].iloc[1])
+        close_last = close[:-1].copy()
+        close_last[0] = open_start
+        daily_pnl[1:] = (close[1:] - close_last) / open_start
+    baseline_data['DAILY_PNL'] = pd.Series(daily_pnl, index=date_range)
+    baseline_data['TOTAL_PNL'] = pd.Series(np.cumsum(daily_pnl), index=date_range)
+
+    if len(_baseline_cache) >= 32:
+        _baseline_cache.clear()
+    _baseline_cache[key] = (csv, baseline_data)
+    return dict(baseline_data)
+
+
+def baseline_csv(exchange, base_index, logger):
+    ''' data of base_index, read once per process and again only if the csv changed '''
+    key = (exchange.lower(), base_index.lower())
+    file_name = '%s/historicalData/%s.csv' % key
+    if not os.path.exists(file_name):
+        assert data_available(exchange, [base_index], logger)
+    mtime = os.path.getmtime(file_name)
+    if key not in _baseline_csv or _baseline_csv[key][0] != mtime:
+        _baseline_csv[key] = (mtime, read_market_csv(exchange, base_index))
+    return _baseline_csv[key][1]
 
 
 def analyze(exchange, markets, back_data):
+    import matplotlib.pyplot as plt
     plt.close('all')
     f, plot_arr = plt.subplots(2, sharex=True)
     plot_arr[0].set_title('Open')
@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+from auquanToolbox.metrics import metrics, baseline, rolling_metrics
+from auquanToolbox.drawdowns import drawdown_stats
+from auquanToolbox.engine import DAILY
+
+__all__ = ['BacktestResult']
+
+
+class BacktestResult(object):
+    ''' outcome of a backtest, returned by backtest(..., headless=True)
+
+    back_data holds every feature for the traded dates, starting the day before the first trade.
+    Nothing is written to disk or shown until one of writecsv, writeresult, writejson or loadgui is called.
+    With backtest(..., timing=True) timings holds the time spent in every stage, see StageTimer.timings,
+    and with profile=True profile is the cProfile.Profile of trading_strategy.
+    freq is the bar length the backtest ran at, the base index is aggregated to it.
+    '''
+
+    def __init__(self, back_data, budget, exchange=None, base_index=None, logger=None, timings=None, profile=None, freq=DAILY):
+        self.back_data = back_data
+        self.timings = timings
+        self.profile = profile
+        self.budget = budget
+        self.exchange = exchange
+        self.base_index = base_index
+        self.freq = freq
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self._stats = None
+        self._baseline_data = None
+
+    @property
+    def dates(self):
+        return self.back_data['DAILY_PNL'].index
+
+    @property
+    def markets(self):
+        return self.back_data['DAILY_PNL'].columns
+
+    @property
+    def daily_pnl(self):
+        return self.back_data['DAILY_PNL'] / self.budget
+
+    @property
+    def total_pnl(self):
+        return self.back_data['TOTAL_PNL'] / self.budget
+
+    @property
+    def baseline_data(self):
+        ''' baseline of base_index over the result dates, empty without a base_index '''
+        if self._baseline_data is None:
+            if self.base_index:
+                self._baseline_data = baseline(self.exchange, self.base_index, self.dates, self.logger, self.freq)
+            else:
+                self._baseline_data = {}
+        return self._baseline_data
+
+    @property
+    def stats(self):
+        ''' stats of metrics, the same loadgui shows '''
+        if self._stats is None:
+            self._stats = metrics(self.daily_pnl, self.total_pnl, self.baseline_data, self.base_index, self.freq)
+        return self._stats
+
+    def rolling(self, window):
+        ''' rolling_metrics over window dates for every market and for the TOTAL PORTFOLIO column '''
+        daily_return = self.daily_pnl
+        daily_return['TOTAL PORTFOLIO'] = daily_return.sum(axis=1)
+        base_return = self.baseline_data['DAILY_PNL'] if self.base_index else None
+        return rolling_metrics(daily_return, window, base_return, self.freq)
+
+    def drawdowns(self):
+        ''' drawdown_stats of the total pnl (as a fraction of budget) of every market and of the TOTAL PORTFOLIO '''
+        total_return = self.total_pnl
+        total_return['TOTAL PORTFOLIO'] = total_return.sum(axis=1)
+        return drawdown_stats(total_return)
+
+    def writecsv(self):
+        from auquanToolbox.toolbox import writecsv
+        writecsv(self.back_data, self.budget)
+
+    def writeresult(self, file_name=None, compressed=True):
+        ''' writes back_data in the columnar format loadresult reads, see resultfile.writeresult '''
+        from auquanToolbox.resultfile import writeresult
+        return writeresult(self.back_data, self.budget, self.exchange, self.base_index, file_name, compressed, self.freq)
+
+    def writejson(self, rolling_window=None, compact=False, fields=None, every=1, precision=None, binary=False):
+        ''' writejson of the result, reusing stats. compact and the arguments after it are those of compact_json '''
+        from auquanToolbox.toolbox import writejson
+        stats = self.stats if fields is None or 'metrics' in fields else None
+        return writejson(self.back_data, self.budget, self.baseline_data, self.base_index, rolling_window,
+                         stats, compact, fields, every, precision, binary, self.freq)
+
+    def loadgui(self):
+        from auquanToolbox.toolbox import loadgui
+        loadgui(self.back_data, self.exchange, self.base_index, self.budget, self.logger, self.freq)
@@ -0,0 +1,152 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import inspect
+import json
+import marshal
+import os
+import pickle
+from functools import partial
+import pandas as pd
+from auquanToolbox.datacache import csv_path
+from auquanToolbox.engine import DAILY
+from auquanToolbox.resultfile import writeresult, loadresult
+
+__all__ = ['RESULT_CACHE_DIR', 'RESULT_CACHE_BYTES', 'cache_key', 'data_fingerprint', 'strategy_fingerprint',
+           'cached_result', 'store_result', 'evict']
+
+# Results of earlier backtests, one <key>.npz per run in the format of writeresult.
+# key is a hash of the backtest settings, of the strategy code and of the size and mtime of every
+# data file read, so editing the strategy or downloading new data never returns a stale result.
+RESULT_CACHE_DIR = 'resultCache/'
+# least recently used results are removed once the cache holds more than this many bytes
+RESULT_CACHE_BYTES = 1024 * 1024 * 1024
+
+
+def cache_dir_name(result_cache):
+    ''' directory of the result_cache argument of backtest and sweep, True for RESULT_CACHE_DIR '''
+    return RESULT_CACHE_DIR if result_cache is True else result_cache
+
+
+def cache_key(exchange, markets, trading_strategy, settings):
+    ''' hash identifying a backtest, or None while some data file is not downloaded yet
+    or when the strategy can't be fingerprinted
+    Args:
+        settings: dict of everything else the result depends on, such as dates, lookback and budget
+    '''
+    fingerprint = data_fingerprint(exchange, markets)
+    if fingerprint is None:
+        return None
+    strategy = strategy_fingerprint(trading_strategy)
+    if strategy is None:
+        return None
+    key = {'exchange': exchange.lower(), 'markets': [m.upper() for m in markets], 'data': fingerprint,
+           'strategy': strategy,
+           'settings': dict((name, str(value)) for name, value in settings.items())}
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def data_fingerprint(exchange, markets):
+    ''' size and mtime of the csv of every market, and of the exchange list when markets is empty '''
+    files = ['%s/%s.txt' % (exchange.lower(), exchange.lower())] if len(markets) == 0 else []
+    if len(markets) == 0 and os.path.exists(files[0]):
+        with open(files[0]) as f:
+            markets = [line.strip() for line in f]
+    files += [csv_path(exchange, m) for m in markets]
+    fingerprint = []
+    for file_name in files:
+        if not os.path.exists(file_name):
+            return None
+        stat = os.stat(file_name)
+        fingerprint.append([file_name, stat.st_size, stat.st_mtime])
+    return fingerprint
+
+
+def strategy_fingerprint(trading_strategy, _seen=None):
+    ''' hash of the source file of trading_strategy, or of its byte code when there is no source,
+    together with its name, the arguments bound by functools.partial and the values it closes over.
+    None when one of those values can't be pickled, then the result can't be cached
+    '''
+    _seen = set() if _seen is None else _seen
+    digest = hashlib.sha1()
+    while isinstance(trading_strategy, partial):
+        values = list(trading_strategy.args) + sorted((trading_strategy.keywords or {}).items())
+        if not _update_values(digest, values, _seen):
+            return None
+        trading_strategy = trading_strategy.func
+
+    digest.update(('%s.%s' % (getattr(trading_strategy, '__module__', ''),
+                              getattr(trading_strategy, '__name__', repr(trading_strategy)))).encode('utf-8'))
+    if id(trading_strategy) in _seen:
+        # a recursive function closing over itself
+        return digest.hexdigest()
+    _seen.add(id(trading_strategy))
+    closure = getattr(trading_strategy, '__closure__', None) or ()
+    if not _update_values(digest, [cell.cell_contents for cell in closure], _seen):
+        return None
+    try:
+        # the whole file, so helpers the strategy calls are covered too
+        with open(inspect.getsourcefile(trading_strategy), 'rb') as f:
+            digest.update(f.read())
+    except (TypeError, IOError, OSError):
+        code = getattr(trading_strategy, '__code__', None)
+        if code is not None:
+            digest.update(marshal.dumps(code))
+    return digest.hexdigest()
+
+
+def _update_values(digest, values, seen):
+    # the pickled bytes of every value, repr would cut arrays short and only give the address of most objects
+    for value in values:
+        if inspect.isfunction(value) or isinstance(value, partial):
+            value_hash = strategy_fingerprint(value, seen)
+            if value_hash is None:
+                return False
+            digest.update(value_hash.encode('utf-8'))
+            continue
+        try:
+            digest.update(pickle.dumps(value, 2))
+        except Exception:
+            return False
+    return True
+
+
+def cached_result(dir_name, key):
+    ''' BacktestResult stored under key, or None. A hit counts as a use for the eviction order '''
+    if key is None:
+        return None
+    file_name = os.path.join(dir_name, '%s.npz' % key)
+    if not os.path.exists(file_name):
+        return None
+    try:
+        result = loadresult(file_name)
+    except (IOError, OSError, ValueError, KeyError):
+        # unreadable, e.g. written by an incompatible version
+        return None
+    os.utime(file_name, None)
+    return result
+
+
+def store_result(dir_name, key, back_data, budget, exchange=None, base_index=None, freq=DAILY):
+    if key is not None:
+        writeresult(back_data, budget, exchange, base_index, os.path.join(dir_name, '%s.npz' % key), freq=freq)
+
+
+def evict(dir_name, max_bytes=None):
+    ''' removes the least recently used results until the cache holds at most max_bytes, RESULT_CACHE_BYTES by default '''
+    if max_bytes is None:
+        max_bytes = RESULT_CACHE_BYTES
+    if not os.path.exists(dir_name):
+        return
+    files = [os.path.join(dir_name, f) for f in os.listdir(dir_name) if f.endswith('.npz')]
+    files = sorted((os.stat(f).st_mtime, os.path.getsize(f), f) for f in files)
+    total = sum(size for (mtime, size, f) in files)
+    for (mtime, size, f) in files:
+        if total <= max_bytes:
+            break
+        os.remove(f)
+        total -= size
+
+
+def normalized_date(date):
+    # '2016-1-4' and '2016-01-04' are the same backtest, the time of day is kept for intraday bars
+    return pd.to_datetime(date).isoformat()
@@ -0,0 +1,115 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import numpy as np
+import pandas as pd
+import datetime as dt
+import json
+import os
+import shutil
+import zipfile
+from auquanToolbox.engine import DAILY
+
+__all__ = ['writeresult', 'loadresult']
+
+# A result holds every feature of back_data as one array, next to the dates and markets they share:
+#   run-<date time>.npz - compressed, one entry per feature plus 'dates' and 'meta'
+#   run-<date time>/    - uncompressed, <i>.npy per feature plus dates.npy and meta.json, memory mappable
+# meta is budget, exchange, base_index, bar freq, markets, and the features in file order with whether they
+# hold one value per date (FUNDS, VALUE, MARGIN) or one per market
+
+
+def writeresult(back_data, budget, exchange=None, base_index=None, file_name=None, compressed=True, freq=DAILY):
+    ''' writes back_data to runLogs/run-<date time>.npz, or to the directory runLogs/run-<date time>/
+    when not compressed, without building any table first
+    Returns:
+        the path written, readable with loadresult
+    '''
+    if file_name is None:
+        file_name = 'runLogs/run-%s' % dt.datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+        if compressed:
+            file_name += '.npz'
+    dir_name = os.path.dirname(file_name)
+    if dir_name and not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+
+    features = list(back_data.keys())
+    meta = {'budget': budget, 'exchange': exchange, 'base_index': base_index, 'freq': freq,
+            'markets': [str(m) for m in back_data['DAILY_PNL'].columns],
+            'features': features, 'series': [f for f in features if back_data[f].ndim == 1]}
+    dates = back_data['DAILY_PNL'].index.asi8
+    arrays = [feature_array(back_data[f]) for f in features]
+
+    # written under a temporary name first so an interrupted run never leaves a half written result
+    tmp_name = file_name + '.part'
+    if compressed:
+        entries = [('dates', dates), ('meta', np.array(json.dumps(meta)))] + \
+            [('%d' % i, a) for i, a in enumerate(arrays)]
+        write_npz(tmp_name, entries)
+    else:
+        os.makedirs(tmp_name)
+        np.save(os.path.join(tmp_name, 'dates.npy'), dates)
+        for i, a in enumerate(arrays):
+            np.save(os.path.join(tmp_name, '%d.npy' % i), a)
+        with open(os.path.join(tmp_name, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    if os.path.isdir(file_name):
+        shutil.rmtree(file_name)
+    elif os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(tmp_name, file_name)
+    return file_name
+
+
+def loadresult(file_name, mmap=True):
+    ''' reads a result written by writeresult
+    Uncompressed results are memory mapped read-only unless mmap is False.
+    Returns:
+        BacktestResult over the saved back_data
+    '''
+    from auquanToolbox.result import BacktestResult
+    if os.path.isdir(file_name):
+        with open(os.path.join(file_name, 'meta.json')) as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        dates = np.load(os.path.join(file_name, 'dates.npy'))
+        arrays = [np.load(os.path.join(file_name, '%d.npy' % i), mmap_mode=mmap_mode)
+                  for i in range(len(meta['features']))]
+    else:
+        with np.load(file_name) as npz:
+            meta = json.loads(str(npz['meta']))
+            dates = npz['dates']
+            arrays = [npz['%d' % i] for i in range(len(meta['features']))]
+
+    index = pd.DatetimeIndex(dates.view('datetime64[ns]'))
+    back_data = {}
+    for feature, a in zip(meta['features'], arrays):
+        if feature in meta['series']:
+            back_data[feature] = pd.Series(a, index=index)
+        else:
+            back_data[feature] = pd.DataFrame(a, index=index, columns=meta['markets'])
+    # results written before freq was stored are daily
+    return BacktestResult(back_data, meta['budget'], meta['exchange'], meta['base_index'], freq=meta.get('freq', DAILY))
+
+
+def feature_array(data):
+    values = data.values
+    if values.dtype == object:
+        values = values.astype(float)
+    return np.ascontiguousarray(values)
+
+
+def write_npz(file_name, entries):
+    ''' writes (name, array) entries as an .npz file that np.load reads.
+    Uses the fastest zlib level, which is several times faster than np.savez_compressed
+    for a slightly larger file. Python 2 zipfile has no level, so it falls back to np.savez_compressed
+    '''
+    try:
+        archive = zipfile.ZipFile(file_name, 'w', zipfile.ZIP_DEFLATED, compresslevel=1)
+    except TypeError:
+        with open(file_name, 'wb') as f:
+            np.savez_compressed(f, **dict(entries))
+        return
+    with archive:
+        for name, a in entries:
+            with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(a), allow_pickle=False)
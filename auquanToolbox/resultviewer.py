@@ -21,9 +21,10 @@ except:
     from tkinter import messagebox as tkMessageBox
 
 from auquanToolbox.metrics import metrics, baseline
+from auquanToolbox.engine import DAILY
 
 
-def loadgui(back_data, exchange, base_index, budget, logger):
+def loadgui(back_data, exchange, base_index, budget, logger, freq=DAILY):
 
     ######################
     # Setup data
@@ -43,11 +44,11 @@ def loadgui(back_data, exchange, base_index, budget, logger):
     total_pnl = back_data['TOTAL_PNL'] / budget
 
     if base_index:
-        baseline_data = baseline(exchange, base_index, total_pnl.index, logger)
-        stats = metrics(daily_pnl, total_pnl, baseline_data, base_index)
+        baseline_data = baseline(exchange, base_index, total_pnl.index, logger, freq)
+        stats = metrics(daily_pnl, total_pnl, baseline_data, base_index, freq)
     else:
         baseline_data = {}
-        stats = metrics(daily_pnl, total_pnl, {}, base_index)
+        stats = metrics(daily_pnl, total_pnl, {}, base_index, freq)
 
     daily_return = daily_pnl.sum(axis=1)
     total_return = total_pnl.sum(axis=1)
@@ -0,0 +1,278 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import numpy as np
+import pandas as pd
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from auquanToolbox.dataloader import load_data, data_available
+from auquanToolbox.engine import MARKET_STATE, PORTFOLIO_STATE, DAILY, bar_end
+from auquanToolbox.result import BacktestResult
+from auquanToolbox.tradingcalendar import TradingCalendar
+from auquanToolbox.toolbox import run_backtest
+from auquanToolbox.resultcache import cache_dir_name, cache_key, cached_result, store_result, evict, normalized_date
+
+__all__ = ['sweep', 'compare_strategies', 'walk_forward', 'param_grid', 'BACKTEST_PARAMS']
+
+# parameters of a sweep that are settings of the backtest, all other parameters are passed to trading_strategy
+BACKTEST_PARAMS = ['date_start', 'date_end', 'lookback', 'budget']
+
+# market data of the sweep, opened by every worker process
+_shared = {}
+
+
+def sweep(exchange, markets, trading_strategy, date_start, date_end, lookback, params, budget=1000000, base_index='SPX', trading_costs=True, workers=None, logger=None, result_cache=None):
+    ''' runs one headless backtest per parameter combination on a single data load
+    Args:
+        params: dict of parameter -> list of values to try every combination of, or a list of dicts.
+            date_start, date_end, lookback and budget override the backtest settings,
+            any other parameter is passed to trading_strategy as a keyword argument
+        workers: number of processes, defaults to the number of cores.
+            With more than one, trading_strategy has to be a module level function
+        result_cache: True or a directory to keep the result of every combination in, see backtest.
+            A sweep run again after an interruption only runs the combinations not finished yet
+    Returns:
+        DataFrame with one row per combination: its parameters followed by the stats of metrics
+    '''
+
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if workers is None:
+        workers = cpu_count()
+    combinations = param_grid(params)
+    settings = {'date_start': date_start, 'date_end': date_end, 'lookback': lookback, 'budget': budget}
+
+    # load the union of all date ranges once
+    first_start = min([pd.to_datetime(c.get('date_start', date_start)) for c in combinations])
+    last_end = max([pd.to_datetime(c.get('date_end', date_end)) for c in combinations])
+    max_lookback = max([c.get('lookback', lookback) for c in combinations])
+    (back_data, date_range) = load_data(exchange, markets, first_start, last_end, max_lookback, budget, logger, state=False)
+    if base_index:
+        assert data_available(exchange, [base_index], logger)
+
+    settings['cache'] = cache_settings(exchange, markets, result_cache)
+    tasks = [(trading_strategy, c, settings, trading_costs) for c in combinations]
+    stats = run_tasks(tasks, back_data, date_range, exchange, base_index, workers, logger)
+    if result_cache:
+        evict(cache_dir_name(result_cache))
+
+    results = pd.DataFrame([dict(c, **s) for c, s in zip(combinations, stats)])
+    names = param_names(combinations)
+    return results[names + [s for s in results.columns if s not in names]]
+
+
+def compare_strategies(exchange, markets, strategies, date_start, date_end, lookback, budget=1000000, base_index='SPX', trading_costs=True, workers=None, logger=None, result_cache=None):
+    ''' runs several trading strategies headlessly on a single data load
+    Args:
+        strategies: list of trading_strategy functions, or dict of name -> trading_strategy.
+            Every strategy trades its own positions and funds
+        workers: number of processes, defaults to the number of cores.
+            With more than one, the strategies have to be module level functions
+        result_cache: True or a directory to keep the result of every strategy in, see backtest
+    Returns:
+        DataFrame with the stats of metrics as rows and one column per strategy
+    '''
+
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if workers is None:
+        workers = cpu_count()
+    if isinstance(strategies, dict):
+        names = list(strategies.keys())
+        strategies = [strategies[name] for name in names]
+    else:
+        names = [getattr(s, '__name__', 'strategy %d' % i) for i, s in enumerate(strategies)]
+
+    (back_data, date_range) = load_data(exchange, markets, date_start, date_end, lookback, budget, logger, state=False)
+    if base_index:
+        assert data_available(exchange, [base_index], logger)
+
+    settings = {'date_start': date_start, 'date_end': date_end, 'lookback': lookback, 'budget': budget,
+                'cache': cache_settings(exchange, markets, result_cache)}
+    tasks = [(s, {}, settings, trading_costs) for s in strategies]
+    stats = run_tasks(tasks, back_data, date_range, exchange, base_index, workers, logger)
+    if result_cache:
+        evict(cache_dir_name(result_cache))
+
+    comparison = pd.DataFrame(stats).T
+    comparison.columns = names
+    return comparison
+
+
+def walk_forward(exchange, markets, trading_strategy, fit, date_start, date_end, lookback, train_days, test_days, expanding=False, budget=1000000, base_index='SPX', trading_costs=True, workers=None, logger=None):
+    ''' walk-forward evaluation: fit on a train window, trade the test window after it, then roll forward
+    Args:
+        fit: fit(train_data) gets the market data (OPEN, CLOSE...) of the train window and returns
+            a dict of keyword arguments for trading_strategy, or None
+        train_days, test_days: number of trading dates in each train and test window.
+            The first train window starts at date_start, test windows follow each other up to date_end
+        expanding: grow the train window from date_start instead of rolling it forward
+        workers: number of processes for the folds, defaults to the number of cores.
+            With more than one, trading_strategy and fit have to be module level functions
+    Returns:
+        (result, folds): a BacktestResult of the test windows stitched together, and a DataFrame
+        with the dates, fitted parameters and stats of every fold.
+        Every fold starts flat with the full budget, so TOTAL_PNL is the sum of the out-of-sample pnl
+        while FUNDS, VALUE and MARGIN restart at each fold
+    '''
+
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    if workers is None:
+        workers = cpu_count()
+
+    (back_data, date_range) = load_data(exchange, markets, date_start, date_end, lookback, budget, logger, state=False)
+    if base_index:
+        assert data_available(exchange, [base_index], logger)
+
+    trading_dates = date_range[TradingCalendar(date_range).bars(date_start, date_end)]
+    settings = {'lookback': lookback, 'budget': budget}
+    tasks = []
+    for test_start in range(train_days, trading_dates.size, test_days):
+        train_start = 0 if expanding else test_start - train_days
+        test_end = min(test_start + test_days, trading_dates.size) - 1
+        tasks.append((trading_strategy, fit, trading_dates[train_start], trading_dates[test_start - 1],
+                      trading_dates[test_start], trading_dates[test_end], settings, trading_costs))
+    if len(tasks) == 0:
+        raise ValueError("No test window fits between %s and %s after %d train days" % (date_start, date_end, train_days))
+
+    outcomes = run_tasks(tasks, back_data, date_range, exchange, base_index, workers, logger, run_fold)
+
+    folds = []
+    for task, (params, fold_data) in zip(tasks, outcomes):
+        fold = {'Train Start': task[2], 'Train End': task[3], 'Test Start': task[4], 'Test End': task[5],
+                'Params': params}
+        fold.update(BacktestResult(fold_data, budget, exchange, base_index, logger).stats)
+        folds.append(fold)
+
+    # keep the day before the first trade once, then only the traded dates of every fold
+    stitched = {}
+    for feature in outcomes[0][1]:
+        stitched[feature] = pd.concat([outcomes[0][1][feature].iloc[:1]] +
+                                      [fold_data[feature].iloc[1:] for (params, fold_data) in outcomes])
+    stitched['TOTAL_PNL'] = stitched['DAILY_PNL'].cumsum()
+    return BacktestResult(stitched, budget, exchange, base_index, logger), pd.DataFrame(folds)
+
+
+def run_tasks(tasks, back_data, date_range, exchange, base_index, workers, logger, function=None):
+    ''' function (run_task by default) of every task, in order, across up to workers processes sharing back_data '''
+    if function is None:
+        function = run_task
+    markets = back_data['CLOSE'].columns.tolist()
+    if workers > 1 and len(tasks) > 1:
+        dir_name = tempfile.mkdtemp(prefix='auquan-sweep-')
+        try:
+            features = share_market_data(back_data, dir_name)
+            pool = Pool(min(workers, len(tasks)), initializer=init_worker,
+                        initargs=(dir_name, features, date_range, markets, exchange, base_index))
+            try:
+                return pool.map(function, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(dir_name, ignore_errors=True)
+    else:
+        _shared.update({'back_data': back_data, 'date_range': date_range, 'calendar': TradingCalendar(date_range),
+                        'exchange': exchange, 'base_index': base_index, 'logger': logger})
+        try:
+            return [function(task) for task in tasks]
+        finally:
+            _shared.clear()
+
+
+def param_grid(params):
+    ''' all combinations of a dict of parameter -> list of values, a list of dicts is returned as is '''
+    if isinstance(params, dict):
+        names = list(params.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*[params[n] for n in names])]
+    return list(params)
+
+
+def param_names(combinations):
+    names = []
+    for c in combinations:
+        names += [p for p in c if p not in names]
+    return names
+
+
+def share_market_data(back_data, dir_name):
+    ''' saves the market data of back_data as .npy files in dir_name, so processes can memory map them
+    Returns:
+        the list of features saved, in file order
+    '''
+    features = [f for f in back_data if f not in MARKET_STATE and f not in PORTFOLIO_STATE]
+    for i, feature in enumerate(features):
+        np.save(os.path.join(dir_name, '%d.npy' % i), np.ascontiguousarray(back_data[feature].values, dtype=np.float64))
+    return features
+
+
+def open_market_data(dir_name, features, date_range, markets):
+    ''' read-only back_data backed by the files written by share_market_data '''
+    back_data = {}
+    for i, feature in enumerate(features):
+        back_data[feature] = pd.DataFrame(np.load(os.path.join(dir_name, '%d.npy' % i), mmap_mode='r'),
+                                          index=date_range, columns=markets)
+    return back_data
+
+
+def init_worker(dir_name, features, date_range, markets, exchange, base_index):
+    back_data = open_market_data(dir_name, features, date_range, markets)
+    # one calendar per process, shared by all its runs
+    _shared.update({'back_data': back_data, 'date_range': date_range, 'calendar': TradingCalendar(date_range),
+                    'exchange': exchange, 'base_index': base_index, 'logger': logging.getLogger(__name__)})
+
+
+def run_task(task):
+    (trading_strategy, params, settings, trading_costs) = task
+    settings = dict(settings)
+    settings.update((p, v) for p, v in params.items() if p in BACKTEST_PARAMS)
+    strategy_params = dict((p, v) for p, v in params.items() if p not in BACKTEST_PARAMS)
+    if strategy_params:
+        trading_strategy = partial(trading_strategy, **strategy_params)
+
+    # the key holds the engine the task runs with, so results are shared with
+    # backtest(..., engine='numpy', result_cache=...) but not with the pandas engine
+    engine = 'numpy'
+    key = None
+    if settings.get('cache') is not None:
+        (cache_dir, exchange, markets) = settings['cache']
+        key = cache_key(exchange, markets, trading_strategy, {
+            'date_start': normalized_date(settings['date_start']), 'date_end': normalized_date(bar_end(settings['date_end'])),
+            'lookback': settings['lookback'], 'budget': settings['budget'], 'trading_costs': trading_costs,
+            'engine': engine, 'raw_lookback': False, 'compact': False, 'freq': DAILY})
+        result = cached_result(cache_dir, key)
+        if result is not None:
+            return BacktestResult(result.back_data, settings['budget'], _shared['exchange'], _shared['base_index'], _shared['logger']).stats
+
+    back_data = run_backtest(_shared['back_data'], _shared['date_range'], trading_strategy,
+                             settings['date_start'], settings['date_end'], settings['lookback'], settings['budget'],
+                             _shared['logger'], trading_costs=trading_costs, engine=engine, calendar=_shared['calendar'])
+    if key is not None:
+        store_result(cache_dir, key, back_data, settings['budget'], _shared['exchange'], _shared['base_index'])
+    return BacktestResult(back_data, settings['budget'], _shared['exchange'], _shared['base_index'], _shared['logger']).stats
+
+
+def cache_settings(exchange, markets, result_cache):
+    ''' what run_task needs to look results up in result_cache, None when results are not cached '''
+    if not result_cache:
+        return None
+    return (cache_dir_name(result_cache), exchange, markets)
+
+
+def run_fold(task):
+    (trading_strategy, fit, train_start, train_end, test_start, test_end, settings, trading_costs) = task
+    back_data = _shared['back_data']
+    train_data = dict((f, d.loc[train_start:train_end]) for f, d in back_data.items()
+                      if f not in MARKET_STATE and f not in PORTFOLIO_STATE)
+    params = fit(train_data) or {}
+    if params:
+        trading_strategy = partial(trading_strategy, **params)
+
+    fold_data = run_backtest(back_data, _shared['date_range'], trading_strategy, test_start, test_end,
+                             settings['lookback'], settings['budget'], _shared['logger'], trading_costs=trading_costs,
+                             calendar=_shared['calendar'])
+    return params, fold_data
@@ -0,0 +1,72 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import cProfile
+import timeit
+import pandas as pd
+
+__all__ = ['StageTimer', 'NoTimer', 'STAGES']
+
+# stages of a backtest, in the order they run every trading date
+STAGES = ['load_data', 'lookback', 'strategy', 'orders', 'sizing', 'execution', 'bookkeeping', 'callback', 'output']
+
+
+class StageTimer(object):
+    ''' wall time and number of calls of every stage of a backtest
+
+    lap(stage, start) adds the time since start to stage and returns the current time,
+    so back to back stages cost a single clock read each.
+    With profile_strategy, the trading_strategy returned by wrap_strategy runs under cProfile.
+    '''
+
+    def __init__(self, profile_strategy=False):
+        self.seconds = dict((stage, 0.0) for stage in STAGES)
+        self.calls = dict((stage, 0) for stage in STAGES)
+        self.profile = cProfile.Profile() if profile_strategy else None
+
+    def now(self):
+        return timeit.default_timer()
+
+    def lap(self, stage, start):
+        now = timeit.default_timer()
+        self.seconds[stage] += now - start
+        self.calls[stage] += 1
+        return now
+
+    def wrap_strategy(self, trading_strategy):
+        if self.profile is None:
+            return trading_strategy
+        profile = self.profile
+
+        def profiled_strategy(lookback_data):
+            return profile.runcall(trading_strategy, lookback_data)
+        return profiled_strategy
+
+    def timings(self):
+        ''' DataFrame of Seconds, Calls and Seconds per Call for every stage that ran, and their Total '''
+        stages = [stage for stage in STAGES if self.calls[stage] > 0]
+        timings = pd.DataFrame({'Seconds': [self.seconds[stage] for stage in stages],
+                                'Calls': [self.calls[stage] for stage in stages]},
+                               index=stages, columns=['Seconds', 'Calls'])
+        timings.loc['total'] = [timings['Seconds'].sum(), 0]
+        timings['Calls'] = timings['Calls'].astype(int)
+        timings['Seconds per Call'] = timings['Seconds'] / timings['Calls'].where(timings['Calls'] > 0)
+        return timings
+
+    def write(self, name):
+        ''' writes the timings to runLogs/timing-<name>.csv and the strategy profile to runLogs/profile-<name>.prof '''
+        self.timings().to_csv('runLogs/timing-%s.csv' % name, index_label='Stage')
+        if self.profile is not None:
+            self.profile.dump_stats('runLogs/profile-%s.prof' % name)
+
+
+class NoTimer(object):
+    ''' stands in for StageTimer when timing is off, so timing a stage costs one empty method call '''
+    profile = None
+
+    def now(self):
+        return 0
+
+    def lap(self, stage, start):
+        return 0
+
+    def wrap_strategy(self, trading_strategy):
+        return trading_strategy
@@ -3,40 +3,309 @@ import numpy as np
 import pandas as pd
 import os
 import json
+import base64
 import logging
 import datetime as dt
-from auquanToolbox.dataloader import load_data
-from auquanToolbox.resultviewer import loadgui
-from auquanToolbox.metrics import metrics, baseline
-import urllib2
+from logging.handlers import MemoryHandler
+try:
+    from queue import Queue
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    # Python 2 logs synchronously
+    QueueHandler = None
+from auquanToolbox.dataloader import load_data, init_state
+from auquanToolbox.metrics import metrics, baseline, OnlineMetrics, rolling_metrics
+from auquanToolbox.engine import MARKET_STATE, PORTFOLIO_STATE, DAILY, to_arrays, to_frames, LookbackData, peak_memory, bar_end, state_arrays
+from auquanToolbox.tradingcalendar import TradingCalendar
+from auquanToolbox.result import BacktestResult
+from auquanToolbox.timing import StageTimer, NoTimer
+from auquanToolbox.resultfile import writeresult
+from auquanToolbox.resultcache import cache_dir_name, cache_key, cached_result, store_result, evict, normalized_date
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+
+def backtest(exchange, markets, trading_strategy, date_start, date_end, lookback, budget=1000000, verbose=False, base_index='SPX', trading_costs=True, isJson=False, engine='pandas', raw_lookback=False, use_cache=False, workers=1, headless=False, callback=None, compact=False, chunk_size=None, timing=False, profile=False, quiet=False, output='npz', result_cache=None, freq=DAILY):
+
+    if headless:
+        # no run log, version check, csv or GUI
+        logger = logging.getLogger(__name__)
+    else:
+        logger = get_logger(quiet)
+
+    try:
+        if not headless and updateCheck():
+            logger.warn('Your version of auquanToolbox is not the most updated.' +
+                        ' If you are using pip, please use \'pip install -U auquanToolbox\'.' +
+                        ' If you downloaded the package, you need to go to https://github.com/Auquan/auquan-toolbox-python' +
+                        ' to redownload that package.')
+
+        # Verify Settings
+
+        try:
+            assert(isinstance(lookback, int)), "Lookback is invalid"
+        except AssertionError:
+            logger.exception("Lookback is invalid")
+            raise
+
+        check_engine(engine, raw_lookback, logger, chunk_size)
+        try:
+            assert(output in ['npz', 'npy', 'csv']), "Output is invalid"
+        except AssertionError:
+            logger.exception("Output should be 'npz', 'npy' or 'csv'")
+            raise
+        timer = StageTimer(profile) if timing or profile else NoTimer()
+
+        # A run that stops early, is profiled or needs the baseline of the whole date range always runs
+        cache_dir = None
+        if result_cache and callback is None and not profile and not isJson:
+            cache_dir = cache_dir_name(result_cache)
+            settings = {'date_start': normalized_date(date_start), 'date_end': normalized_date(bar_end(date_end, freq)),
+                        'lookback': lookback, 'budget': budget, 'trading_costs': trading_costs,
+                        'engine': engine, 'raw_lookback': raw_lookback, 'compact': compact, 'freq': freq}
+        result = cached_result(cache_dir, cache_key(exchange, markets, trading_strategy, settings)) if cache_dir else None
+
+        if result is not None:
+            back_data = result.back_data
+            logger.info('Results of an identical earlier run read from %s' % cache_dir)
+        else:
+            # Load data for backtest
+
+            lap_start = timer.now()
+            (back_data, date_range) = load_data(exchange, markets,
+                                                date_start, date_end, lookback, budget, logger, use_cache=use_cache, workers=workers, compact=compact, freq=freq,
+                                                state=engine == 'pandas', stream=engine == 'numpy' and bool(chunk_size))
+            timer.lap('load_data', lap_start)
+            logger.info('Initial funds: %0.2f' % budget)
+            logger.info('------------------------------------')
+            logger.info('Evaluating...')
+
+            back_data = run_backtest(back_data, date_range, trading_strategy, date_start, date_end, lookback,
+                                     budget, logger, verbose, trading_costs, engine, raw_lookback, callback, compact, chunk_size, timer, freq,
+                                     exchange=exchange, base_index=base_index)
+
+            if cache_dir:
+                # the key is taken again as load_data may just have downloaded the data
+                store_result(cache_dir, cache_key(exchange, markets, trading_strategy, settings), back_data, budget, exchange, base_index, freq)
+                evict(cache_dir)
+
+        if headless:
+            if timing or profile:
+                return BacktestResult(back_data, budget, exchange, base_index, logger, timer.timings(), timer.profile, freq)
+            return BacktestResult(back_data, budget, exchange, base_index, logger, freq=freq)
+
+        lap_start = timer.now()
+        if isJson:
+            if base_index:
+                baseline_data = baseline(exchange, base_index, date_range, logger, freq)
+                json_data = writejson(back_data, budget, {feature: data.loc[back_data['DAILY_PNL'].index] for feature, data in baseline_data.items()}, base_index, freq=freq)
+            else:
+                json_data = writejson(back_data, budget, {}, base_index, freq=freq)
+            timer.lap('output', lap_start)
+            log_timings(timer, logger)
+            return json_data
+        else:
+            if output == 'csv':
+                writecsv(back_data, budget)
+            else:
+                # named after the run log
+                file_name = 'runLogs/run-%s%s' % (logger.name, '.npz' if output == 'npz' else '')
+                writeresult(back_data, budget, exchange, base_index, file_name, output == 'npz', freq)
+                logger.info('Results written to %s, read them back with loadresult' % file_name)
+            timer.lap('output', lap_start)
+            log_timings(timer, logger)
+
+        logger.info('Plotting Results...')
+
+        loadgui(back_data, exchange, base_index, budget, logger, freq)
+    finally:
+        if not headless:
+            close_logger(logger)
+
+
+def run_backtest(back_data, date_range, trading_strategy, date_start, date_end, lookback, budget=1000000, logger=None, verbose=False, trading_costs=True, engine='numpy', raw_lookback=False, callback=None, compact=False, chunk_size=None, timer=None, freq=DAILY, calendar=None, exchange=None, base_index=None):
+    ''' runs trading_strategy over data returned by load_data, without writing any output
+    With the numpy engine back_data is left untouched and can be reused for further runs,
+    the pandas engine writes its state into back_data.
+    With the numpy engine trading_strategy may also return its order as a dict of
+    SIGNAL, WEIGHTS and PRICE arrays in the order of the markets, see order_arrays.
+    callback(date, online_metrics) is called after every trading date with an OnlineMetrics
+    of the run so far, the backtest stops early when it returns True. With exchange and base_index
+    it is also fed the daily return of base_index, for Base Return(%) and Beta.
+    compact keeps share counts as int32 and market data as float32 in the numpy engine.
+    With chunk_size, the numpy engine converts market data chunk_size dates at a time
+    (plus the lookback before them) instead of copying all of it up front. Loaded with
+    load_data(use_cache=True, stream=True), those rows are the only ones read from the cache.
+    timer, a StageTimer, accumulates the time spent in every stage of the loop.
+    freq is the bar frequency back_data was loaded with, see load_data. Bars other than daily
+    are traded one after the other, a date_end without a time of day includes all its bars.
+    calendar, a TradingCalendar of date_range, gives the bars to trade. It is built from date_range
+    and freq when not given, runs over the same data can share one.
+    Returns:
+        back_data for the traded dates, starting the day before the first trade
+    '''
+
+    if logger is None:
+        logger = logging.getLogger(__name__)
+    check_engine(engine, raw_lookback, logger, chunk_size)
+    if timer is None:
+        timer = NoTimer()
+    if calendar is None:
+        calendar = TradingCalendar(date_range, freq)
+    try:
+        assert(calendar.matches(date_range)), "Calendar does not match date_range"
+    except AssertionError:
+        logger.exception("Calendar does not match the dates of back_data")
+        raise
+    markets = back_data['CLOSE'].columns.tolist()
+
+    if engine == 'numpy':
+        (back_data, start_index, end, value_curr) = _loop_arrays(
+            back_data, date_range, markets, trading_strategy, date_start, date_end, lookback, budget, logger, verbose, trading_costs, calendar, raw_lookback, callback, compact, chunk_size, timer, exchange, base_index, freq)
+    else:
+        if 'POSITION' not in back_data:
+            init_state(back_data, date_range, markets, budget)
+        (start_index, end, value_curr) = _loop_pandas(
+            back_data, date_range, markets, trading_strategy, date_start, date_end, lookback, budget, logger, verbose, trading_costs, calendar, callback, timer, exchange, base_index, freq)
 
+    logger.info('Final Portfolio Value: %0.2f' % value_curr)
+    if peak_memory() is not None:
+        logger.info('Peak memory: %0.1f MB' % peak_memory())
+
+    return {feature: data[start_index - 1: end + 1] for feature, data in back_data.items()}
 
-def backtest(exchange, markets, trading_strategy, date_start, date_end, lookback, budget=1000000, verbose=False, base_index='SPX', trading_costs=True, isJson=False):
 
-    logger = get_logger()
+def backtest_vectorized(back_data, date_range, signal, weights, price, date_start, date_end, budget=1000000, trading_costs=True, logger=None, freq=DAILY):
+    ''' backtest for strategies that compute their orders for all dates at once
+    Args:
+        back_data, date_range: as returned by load_data
+        signal, weights, price: DataFrames of dates x markets holding the order
+            trading_strategy would have returned for each trading date.
+            Missing entries are treated as 0
+        freq: bar frequency back_data was loaded with, a date_end without a time of day
+            includes all its bars when it is not daily
+    Returns:
+        back_data for the traded dates, same as what backtest passes to writecsv, writejson and loadgui
+    '''
 
-    if updateCheck():
-        logger.warn('Your version of auquanToolbox is not the most updated.' +
-                    ' If you are using pip, please use \'pip install -U auquanToolbox\'.' +
-                    ' If you downloaded the package, you need to go to https://github.com/Auquan/auquan-toolbox-python' +
-                    ' to redownload that package.')
+    if logger is None:
+        logger = logging.getLogger(__name__)
 
-    # Verify Settings
+    stocks = back_data['CLOSE'].columns
+    try:
+        arrays = to_arrays(dict((f, d) for f, d in back_data.items() if f not in MARKET_STATE and f not in PORTFOLIO_STATE))
+    except ValueError:
+        logger.info("Data not formatted properly")
+        raise
+    arrays.update(state_arrays(date_range.size, stocks.size, budget))
 
+    signal = signal.reindex(index=date_range, columns=stocks).fillna(0).values.astype(float)
+    weights = weights.reindex(index=date_range, columns=stocks).fillna(0).values.astype(float)
+    price = price.reindex(index=date_range, columns=stocks).fillna(0).values.astype(float)
+
+    # verify orders for all dates at once
+    try:
+        assert(np.isin(signal, [-1, 0, 1]).all())
+    except AssertionError:
+        logger.info("Signal can only be -1(sell), 0(hold) or 1(buy)")
+        raise
+    try:
+        assert((price >= 0).all())
+    except AssertionError:
+        logger.info("Price cannot be negative")
+        raise
     try:
-        assert(isinstance(lookback, int)), "Lookback is invalid"
+        assert((weights >= 0).all())
     except AssertionError:
-        logger.exception("Lookback is invalid")
+        logger.info(
+            "Please check weights. Weights cannot be negative and should sum to <= 1")
         raise
 
-    # Load data for backtest
+    weights_sum = weights.sum(axis=1)
+    weights[weights_sum > 1] /= weights_sum[weights_sum > 1, np.newaxis]
+
+    trading_days = np.flatnonzero((date_range >= pd.to_datetime(date_start)) &
+                                  (date_range <= bar_end(date_end, freq)))
+    trading_days = trading_days[trading_days > 0]
+    if trading_days.size == 0:
+        raise ValueError("No trading dates between %s and %s" % (date_start, date_end))
+    start_index = trading_days[0]
+    end = trading_days[-1]
+
+    open_ = arrays['OPEN']
+    close = arrays['CLOSE']
+    slippage = np.zeros_like(open_)
+    slippage[1:] = (arrays['HIGH'][:-1] - arrays['LOW'][:-1]) * 0.05
+    position = arrays['POSITION']
+    funds = arrays['FUNDS']
+    cost_to_trade = arrays['COST TO TRADE']
+
+    # sizing depends on the portfolio value reached so far, so only that
+    # recursion walks the dates; everything else is computed in batch below
+    budget_curr = budget
+    margin_curr = arrays['MARGIN'][start_index - 1]
+    margin_open = np.zeros(date_range.size)
+    for t in trading_days:
+        value = budget_curr + margin_curr + (position[t - 1] * open_[t]).sum()
+        quantity = getquantity_array(signal[t], weights[t], open_[t], slippage[t], value, position[t - 1])
+        (position[t], budget_curr, margin_curr, cost_to_trade[t]) = execute_order_array(
+            quantity, price[t], position[t - 1], slippage[t], open_[t], budget_curr, margin_curr, trading_costs)
+        arrays['ORDER'][t] = quantity
+        funds[t] = budget_curr
+        margin_open[t] = margin_curr
+
+    days = slice(start_index, end + 1)
+    last_days = slice(start_index - 1, end)
+    arrays['FILLED_ORDER'][days] = position[days] - position[last_days]
+    arrays['DAILY_PNL'][days] = (position[days] * (close[days] - open_[days]) +
+                                 position[last_days] * (open_[days] - close[last_days])) - cost_to_trade[days]
+    arrays['TOTAL_PNL'][days] = arrays['TOTAL_PNL'][start_index - 1] + \
+        np.cumsum(arrays['DAILY_PNL'][days], axis=0)
+    position_value = position[days] * close[days]
+    arrays['MARGIN'][days] = -np.where(position_value < 0, position_value, 0).sum(axis=1)
+    arrays['VALUE'][days] = funds[days] + margin_open[days] + (margin_open[days] - arrays['MARGIN'][days]) + \
+        np.where(position_value > 0, position_value, 0).sum(axis=1)
+
+    out_of_funds = np.flatnonzero(arrays['VALUE'][days] <= 0)
+    if out_of_funds.size > 0:
+        logger.info('Out of funds. Exiting!')
+        end = start_index + out_of_funds[0]
+    logger.info('Final Portfolio Value: %0.2f' % arrays['VALUE'][end])
+
+    back_data = to_frames(arrays, date_range, stocks)
+    return {feature: data[start_index - 1: end + 1] for feature, data in back_data.items()}
+
+
+def check_engine(engine, raw_lookback, logger, chunk_size=None):
+    try:
+        assert(engine in ['pandas', 'numpy']), "Engine is invalid"
+    except AssertionError:
+        logger.exception("Engine should be 'pandas' or 'numpy'")
+        raise
 
-    (back_data, date_range) = load_data(exchange, markets,
-                                        date_start, date_end, lookback, budget, logger)
-    logger.info('Initial funds: %0.2f' % budget)
-    logger.info('------------------------------------')
-    logger.info('Evaluating...')
+    try:
+        assert(engine == 'numpy' or not raw_lookback), "raw_lookback needs the numpy engine"
+    except AssertionError:
+        logger.exception("raw_lookback is only supported with engine='numpy'")
+        raise
 
+    try:
+        assert(chunk_size is None or (engine == 'numpy' and chunk_size > 0)), "chunk_size is invalid"
+    except AssertionError:
+        logger.exception("chunk_size should be a positive number of dates, with engine='numpy'")
+        raise
+
+
+def _loop_pandas(back_data, date_range, markets, trading_strategy, date_start, date_end, lookback, budget, logger, verbose, trading_costs, calendar, callback=None, timer=None, exchange=None, base_index=None, freq=DAILY):
+
+    if timer is None:
+        timer = NoTimer()
+    trading_strategy = timer.wrap_strategy(trading_strategy)
+    # the per day lines are not even formatted when the logger drops them
+    log_days = not hasattr(logger, 'isEnabledFor') or logger.isEnabledFor(logging.INFO)
+    date_format = 'Trading date :%d %b %Y' if calendar.freq == DAILY else 'Trading date :%d %b %Y %H:%M'
     budget_curr = budget
 
     position_curr = None
@@ -44,15 +313,18 @@ def backtest(exchange, markets, trading_strategy, date_start, date_end, lookback
     cost_to_trade = None
 
     start_index = -1
-
-    for startDate in pd.date_range(start=date_start, end=date_end, freq='B'):
-        if startDate not in date_range:
-            logger.info(startDate.strftime(
-                'Trading date is a Holiday or data not present :%d %b %Y'))
-            continue
-        end = date_range.get_loc(startDate)
+    if callback is not None:
+        online_metrics = OnlineMetrics(freq)
+        # the day before the first trade is part of the results, as in metrics
+        online_metrics.update(0.0, 0.0 if base_index else None)
+    base_returns = None
+
+    for end in calendar.bars(date_start, date_end, logger).tolist():
+        lap_start = timer.now()
         if start_index < 0:
             start_index = end
+            if callback is not None and base_index:
+                base_returns = baseline_returns(exchange, base_index, date_range, start_index, logger, freq)
 
         start = end - lookback
         if start < 0:
@@ -66,7 +338,10 @@ def backtest(exchange, markets, trading_strategy, date_start, date_end, lookback
         # get order and verify
         lookback_data = {feature: data[start: end]
                          for feature, data in back_data.items()}
+        lap_start = timer.lap('lookback', lap_start)
         order = trading_strategy(lookback_data)
+        lap_start = timer.lap('strategy', lap_start)
+        check_order_markets(order.index, markets, logger)
         try:
             assert((order['SIGNAL'].isin([-1, 0, 1])).all())
         except AssertionError:
@@ -86,6 +361,7 @@ def backtest(exchange, markets, trading_strategy, date_start, date_end, lookback
 
         if order['WEIGHTS'].sum() > 1:
             order['WEIGHTS'] = order['WEIGHTS'] / order['WEIGHTS'].sum()
+        lap_start = timer.lap('orders', lap_start)
 
         # evaluate new position based on order and budget
 
@@ -105,8 +381,10 @@ def backtest(exchange, markets, trading_strategy, date_start, date_end, lookback
         value = budget_curr + margin_curr + (position_last * open_curr).sum()
         order['QUANTITY'] = getquantity(
             order, price_curr, slippage, value, position_last, logger)
+        lap_start = timer.lap('sizing', lap_start)
         (position_curr, budget_curr, margin_curr, cost_to_trade) = execute_order(
             order, position_last, slippage, price_curr, budget_curr, margin_curr, logger, trading_costs)
+        lap_start = timer.lap('execution', lap_start)
 
         # set info in back data
         back_data['POSITION'].iloc[end] = position_curr
@@ -137,8 +415,9 @@ def backtest(exchange, markets, trading_strategy, date_start, date_end, lookback
         back_data['COST TO TRADE'].iloc[end] = cost_to_trade
 
         # print to STDOUT
-        logger.info(date_range[end].strftime('Trading date :%d %b %Y'))
-        if verbose:
+        if log_days:
+            logger.info(date_range[end].strftime(date_format))
+        if verbose and log_days:
             s = 'stocks         : %s' % markets + '\n' +\
                 'today open     : %s' % open_curr.values + '\n' +\
                 'today close    : %s' % close_curr.values + '\n' +\
@@ -151,27 +430,189 @@ def backtest(exchange, markets, trading_strategy, date_start, date_end, lookback
                 'Portfolio Value: %0.2f' % value_curr + '\n' +\
                 '------------------------------------'
             logger.info(s)
+        lap_start = timer.lap('bookkeeping', lap_start)
 
         if value_curr <= 0:
             logger.info('Out of funds. Exiting!')
             break
 
-    logger.info('Final Portfolio Value: %0.2f' % value_curr)
+        if callback is not None:
+            online_metrics.update(pnl_curr.sum() / budget,
+                                  base_returns[end - start_index + 1] if base_returns is not None else None)
+            stopped = callback(date_range[end], online_metrics)
+            timer.lap('callback', lap_start)
+            if stopped:
+                logger.info('Stopped by callback. Exiting!')
+                break
 
-    if isJson:
-        if base_index:
-            baseline_data = baseline(exchange, base_index, date_range, logger)
-            return writejson({feature: data[start_index - 1: end + 1] for feature, data in back_data.items()}, budget, {feature: data[start_index - 1: end + 1] for feature, data in baseline_data.items()}, base_index)
+    return start_index, end, value_curr
+
+
+def _loop_arrays(back_data, date_range, markets, trading_strategy, date_start, date_end, lookback, budget, logger, verbose, trading_costs, calendar, raw_lookback=False, callback=None, compact=False, chunk_size=None, timer=None, exchange=None, base_index=None, freq=DAILY):
+
+    # all state lives in (dates x markets) arrays allocated here, whatever state back_data holds,
+    # and is only wrapped into DataFrames once the loop is done
+    stocks = back_data['CLOSE'].columns
+    market_features = [f for f in back_data if f not in MARKET_STATE and f not in PORTFOLIO_STATE]
+    try:
+        if chunk_size:
+            arrays = {}
         else:
-            return writejson({feature: data[start_index - 1: end + 1] for feature, data in back_data.items()}, budget, {}, base_index)
-    else:
-        writecsv({feature: data[start_index - 1: end + 1]
-                  for feature, data in back_data.items()}, budget)
+            arrays = to_arrays(dict((f, back_data[f]) for f in market_features), compact)
+    except ValueError:
+        logger.info("Data not formatted properly")
+        raise
+    arrays.update(state_arrays(date_range.size, stocks.size, budget, compact))
+    # data holds the rows offset to stop of every feature, all of them without chunks
+    data = arrays
+    offset = 0
+    stop = 0 if chunk_size else date_range.size
+
+    budget_curr = budget
+    if timer is None:
+        timer = NoTimer()
+    trading_strategy = timer.wrap_strategy(trading_strategy)
+    # the per day lines are not even formatted when the logger drops them
+    log_days = not hasattr(logger, 'isEnabledFor') or logger.isEnabledFor(logging.INFO)
+    date_format = 'Trading date :%d %b %Y' if calendar.freq == DAILY else 'Trading date :%d %b %Y %H:%M'
+
+    position_curr = None
+    margin_curr = None
+    cost_to_trade = None
+
+    start_index = -1
+    if callback is not None:
+        online_metrics = OnlineMetrics(freq)
+        # the day before the first trade is part of the results, as in metrics
+        online_metrics.update(0.0, 0.0 if base_index else None)
+    base_returns = None
+
+    for end in calendar.bars(date_start, date_end, logger).tolist():
+        lap_start = timer.now()
+        if start_index < 0:
+            start_index = end
+            if callback is not None and base_index:
+                base_returns = baseline_returns(exchange, base_index, date_range, start_index, logger, freq)
+
+        start = end - lookback
+        if start < 0:
+            start = 0
+
+        if end >= stop:
+            # next chunk: the market data of chunk_size dates and the lookback before them,
+            # next to views of the state arrays over the same rows
+            offset = max(end - lookback - 1, 0)
+            stop = min(end + chunk_size, date_range.size)
+            try:
+                data = to_arrays(dict((f, back_data[f].iloc[offset:stop]) for f in market_features), compact)
+            except ValueError:
+                logger.info("Data not formatted properly")
+                raise
+            data.update((f, arrays[f][offset:stop]) for f in MARKET_STATE + PORTFOLIO_STATE)
+
+        if position_curr is None:
+            position_curr = arrays['POSITION'][end - 1]
+            margin_curr = arrays['MARGIN'][end - 1]
+            cost_to_trade = position_curr * 0
+
+        # get order and verify
+        lookback_data = LookbackData(data, date_range[offset:stop], stocks, start - offset, end - offset, raw_lookback)
+        lap_start = timer.lap('lookback', lap_start)
+        order = trading_strategy(lookback_data)
+        lap_start = timer.lap('strategy', lap_start)
+        (signal, weights, limit_price) = order_arrays(order, stocks, logger)
+        lap_start = timer.lap('orders', lap_start)
+
+        # evaluate new position based on order and budget
+
+        open_curr = data['OPEN'][end - offset]
+        price_curr = open_curr
+        close_curr = data['CLOSE'][end - offset]
+        close_last = data['CLOSE'][end - offset - 1]
+        high = data['HIGH'][end - offset - 1]
+        low = data['LOW'][end - offset - 1]
+
+        slippage = (high - low) * 0.05
+        position_last = arrays['POSITION'][end - 1]
+        value = budget_curr + margin_curr + (position_last * open_curr).sum()
+        quantity = getquantity_array(
+            signal, weights, price_curr, slippage, value, position_last)
+        lap_start = timer.lap('sizing', lap_start)
+        (position_curr, budget_curr, margin_curr, cost_to_trade) = execute_order_array(
+            quantity, limit_price, position_last, slippage, price_curr, budget_curr, margin_curr, trading_costs)
+        lap_start = timer.lap('execution', lap_start)
+
+        # set info in back data
+        arrays['POSITION'][end] = position_curr
+        arrays['ORDER'][end] = quantity
+        arrays['FILLED_ORDER'][end] = position_curr - position_last
+
+        # calculate pnl
+        pnl_curr = (position_curr * (close_curr - open_curr) +
+                    position_last * (open_curr - close_last)) - cost_to_trade
+        arrays['DAILY_PNL'][end] = pnl_curr
+        arrays['TOTAL_PNL'][end] = pnl_curr + arrays['TOTAL_PNL'][end - 1]
+
+        # available funds
+        arrays['FUNDS'][end] = budget_curr
+
+        # funds used as margin
+        is_short = position_curr < 0
+        arrays['MARGIN'][end] = -(position_curr[is_short] * close_curr[is_short]).sum()
+
+        # portfolio value
+        is_long = position_curr > 0
+        value_curr = budget_curr + margin_curr + (margin_curr - arrays['MARGIN'][end]) + (
+            position_curr[is_long] * close_curr[is_long]).sum()
+        arrays['VALUE'][end] = value_curr
+
+        # cost
+        arrays['COST TO TRADE'][end] = cost_to_trade
+
+        # print to STDOUT
+        if log_days:
+            logger.info(date_range[end].strftime(date_format))
+        if verbose and log_days:
+            s = 'stocks         : %s' % markets + '\n' +\
+                'today open     : %s' % open_curr + '\n' +\
+                'today close    : %s' % close_curr + '\n' +\
+                'order          : %s' % quantity + '\n' +\
+                'position       : %s' % position_curr + '\n' +\
+                'cost to trade  : %0.2f' % cost_to_trade.sum() + '\n' +\
+                'Available funds: %0.2f' % budget_curr + '\n' +\
+                'Margin funds   : %0.2f' % margin_curr + '\n' +\
+                'pnl            : %0.2f' % pnl_curr.sum() + '\n' +\
+                'Portfolio Value: %0.2f' % value_curr + '\n' +\
+                '------------------------------------'
+            logger.info(s)
+        lap_start = timer.lap('bookkeeping', lap_start)
+
+        if value_curr <= 0:
+            logger.info('Out of funds. Exiting!')
+            break
+
+        if callback is not None:
+            online_metrics.update(pnl_curr.sum() / budget,
+                                  base_returns[end - start_index + 1] if base_returns is not None else None)
+            stopped = callback(date_range[end], online_metrics)
+            timer.lap('callback', lap_start)
+            if stopped:
+                logger.info('Stopped by callback. Exiting!')
+                break
 
-    logger.info('Plotting Results...')
+    back_data_curr = to_frames(arrays, date_range, stocks)
+    if chunk_size:
+        back_data_curr.update((f, back_data[f]) for f in market_features)
+    return back_data_curr, start_index, end, value_curr
 
-    loadgui({feature: data[start_index - 1: end + 1] for feature,
-             data in back_data.items()}, exchange, base_index, budget, logger)
+
+def baseline_returns(exchange, base_index, date_range, first, logger, freq=DAILY):
+    ''' daily returns of base_index from the date before the first trade at position first on,
+    the same values metrics measures over the results of a run starting there
+    '''
+    returns = baseline(exchange, base_index, date_range[first - 1:], logger, freq)['DAILY_PNL'].values
+    # a date without base index data counts as flat, rather than spoiling every stat after it
+    return np.nan_to_num(returns)
 
 
 def commission():
@@ -222,10 +663,117 @@ def execute_order(order, position, slippage, price, budget, margin, logger, trad
     return position_curr, budget - order_value - margin_call - cost_to_trade.sum(), margin_curr, cost_to_trade
 
 
-def get_logger():
+def order_arrays(order, markets, logger):
+    ''' validates the order returned by trading_strategy and normalizes its weights, in one pass
+    Args:
+        order: DataFrame with SIGNAL, WEIGHTS and PRICE columns indexed by market, or a dict of
+            SIGNAL, WEIGHTS and PRICE arrays already in the order of markets
+    Returns:
+        (signal, weights, limit_price) float arrays in the order of markets
+    '''
+    if isinstance(order, pd.DataFrame):
+        values = order[['SIGNAL', 'WEIGHTS', 'PRICE']].values.astype(float).T
+        if not order.index.equals(markets):
+            check_order_markets(order.index, markets, logger)
+            values = values[:, order.index.get_indexer(markets)]
+    else:
+        values = np.array([order['SIGNAL'], order['WEIGHTS'], order['PRICE']], dtype=float)
+        try:
+            assert(values.shape[1] == len(markets)), "Order does not match markets"
+        except AssertionError:
+            logger.info("Order should have one SIGNAL, WEIGHTS and PRICE per market")
+            raise
+    (signal, weights, limit_price) = values
+
+    try:
+        assert(((signal == -1) | (signal == 0) | (signal == 1)).all())
+    except AssertionError:
+        logger.info("Signal can only be -1(sell), 0(hold) or 1(buy)")
+        raise
+    try:
+        assert((limit_price >= 0).all())
+    except AssertionError:
+        logger.info("Price cannot be negative")
+        raise
+    try:
+        assert((weights >= 0).all())
+    except AssertionError:
+        logger.info(
+            "Please check weights. Weights cannot be negative and should sum to <= 1")
+        raise
+
+    weights_sum = np.nansum(weights)
+    if weights_sum > 1:
+        values[1] = weights / weights_sum
+    return values[0], values[1], values[2]
+
+
+def check_order_markets(index, markets, logger):
+    # an order has to hold a row for every market, a missing one would silently close its position
+    missing = [m for m in markets if m not in index]
+    try:
+        assert(len(missing) == 0), "Order is missing markets"
+    except AssertionError:
+        logger.info("Order should have SIGNAL, WEIGHTS and PRICE for every market, missing: %s" % ', '.join(missing))
+        raise
+
+
+def getquantity_array(signal, weights, price, slippage, value, position):
+    # same as getquantity, on arrays in market order
+    cost_to_trade = slippage + commission()
+    weights_sum = np.nansum(weights)
+    if weights_sum > 0:
+        new_portfolio_value = (weights_sum * value) / \
+            np.nansum(weights * (price + cost_to_trade) / price)
+        desired_position = weights * new_portfolio_value / price
+        quantity = (signal * desired_position) - position
+    else:
+        quantity = -position
+    return quantity.astype(np.int64)
+
+
+def execute_order_array(quantity, limit_price, position, slippage, price, budget, margin, trading_costs):
+    # same as execute_order, on arrays in market order
+    direction = np.sign(quantity)
+    trade_criteria = np.where(direction * price > direction * limit_price,
+                              limit_price == 0, direction * price <= direction * limit_price)
+
+    position_curr = position + np.where(trade_criteria, quantity, 0)
+    total_commission = 0 * position_curr
+    adj_slippage = 0 * position_curr
+
+    is_short = position_curr < 0
+    margin_curr = -(position_curr[is_short] * price[is_short]).sum()
+    if trading_costs:
+        total_commission = np.abs(position_curr - position) * commission()
+        slippage_adjusted_price = price + (direction * slippage)
+        slippage_adjusted_price[slippage_adjusted_price < 0] = 0
+        adj_slippage = np.abs(position_curr - position) * \
+            np.abs(price - slippage_adjusted_price)
+    margin_call = margin_curr - margin
+    order_value = ((position_curr - position) * price).sum() + margin_call
+    cost_to_trade = total_commission + adj_slippage
+    return position_curr, budget - order_value - margin_call - cost_to_trade.sum(), margin_curr, cost_to_trade
+
+
+def log_timings(timer, logger):
+    ''' logs the stage timings of a timed backtest and writes them next to its run log '''
+    if isinstance(timer, StageTimer):
+        logger.info('Time spent per stage:\n%s' % timer.timings().to_string())
+        timer.write(logger.name)
+
+
+def get_logger(quiet=False, asynchronous=True):
+    ''' logger of a run, writing to runLogs/run-<date time>.txt and to the console
+    With asynchronous, records are handed to a background thread through a queue, and the file
+    is written in batches, so the backtest loop does not wait on disk or console output.
+    quiet only logs warnings and errors. close_logger stops the thread and closes the file.
+    '''
     logger_name = dt.datetime.now().strftime('%Y-%m-%d %H-%M-%S')
     logger = logging.getLogger(logger_name)
-    logger.setLevel(logging.DEBUG)
+    # a run started within the same second gets the same logger, drop the handlers of the last one
+    close_logger(logger)
+    logger.setLevel(logging.WARNING if quiet else logging.DEBUG)
     logger_dir = 'runLogs/'
     logger_file = '%srun-%s.txt' % (logger_dir, logger_name)
     if not os.path.exists(logger_dir):
@@ -235,11 +783,33 @@ def get_logger():
     console_handler = logging.StreamHandler()
     file_handler.setFormatter(formatter)
     console_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    if asynchronous and QueueHandler is not None:
+        # the file gets records 256 at a time, errors are written straight away
+        batch_handler = MemoryHandler(256, logging.ERROR, file_handler)
+        queue = Queue()
+        logger.listener = QueueListener(queue, batch_handler, console_handler)
+        logger.run_handlers = [batch_handler, file_handler, console_handler]
+        logger.addHandler(QueueHandler(queue))
+        logger.listener.start()
+    else:
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
     return logger
 
 
+def close_logger(logger):
+    ''' waits for the records queued by a logger from get_logger to be written, then closes its handlers '''
+    if getattr(logger, 'listener', None) is not None:
+        logger.listener.stop()
+        for handler in logger.run_handlers:
+            handler.close()
+        logger.listener = None
+        logger.run_handlers = []
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
 class noop_logger:
     def info(self, str):
         print(str)
@@ -256,23 +826,23 @@ def get_noop_logger():
 
 
 def writecsv(back_data, budget):
+    ''' writes back_data as one wide table to runLogs/run-<date time>.csv, newest date first '''
 
-    results = pd.DataFrame(
-        0, index=back_data['DAILY_PNL'].index, columns=['Daily Returns'])
-    results['Daily Returns'] = back_data[
-        'DAILY_PNL'].sum(axis=1) * 100 / budget
-    results['Total Returns'] = back_data[
-        'TOTAL_PNL'].sum(axis=1) * 100 / budget
-    results['Funds'] = back_data['FUNDS']
-    results['Margin'] = back_data['MARGIN']
-    results['Portfolio Value'] = back_data['VALUE']
+    columns = [('Daily Returns', back_data['DAILY_PNL'].sum(axis=1) * 100 / budget),
+               ('Total Returns', back_data['TOTAL_PNL'].sum(axis=1) * 100 / budget),
+               ('Funds', back_data['FUNDS']),
+               ('Margin', back_data['MARGIN']),
+               ('Portfolio Value', back_data['VALUE'])]
     for stock in back_data['DAILY_PNL'].columns.tolist():
-        results['%s Position' % stock] = back_data['POSITION'][stock]
-        results['%s Order' % stock] = back_data['ORDER'][stock]
-        results['%s Filled Order' % stock] = back_data['FILLED_ORDER'][stock]
-        results['%s Trade Price' % stock] = back_data['OPEN'][stock]
-        results['%s Cost to Trade' % stock] = back_data['COST TO TRADE'][stock]
-        results['%s PnL' % stock] = back_data['DAILY_PNL'][stock]
+        columns += [('%s Position' % stock, back_data['POSITION'][stock]),
+                    ('%s Order' % stock, back_data['ORDER'][stock]),
+                    ('%s Filled Order' % stock, back_data['FILLED_ORDER'][stock]),
+                    ('%s Trade Price' % stock, back_data['OPEN'][stock]),
+                    ('%s Cost to Trade' % stock, back_data['COST TO TRADE'][stock]),
+                    ('%s PnL' % stock, back_data['DAILY_PNL'][stock])]
+    # one concatenation instead of inserting six columns per stock
+    results = pd.concat([column for name, column in columns], axis=1)
+    results.columns = [name for name, column in columns]
 
     results = results.sort_index(axis=0, ascending=False)
     csv_dir = 'runLogs/'
@@ -284,26 +854,24 @@ def writecsv(back_data, budget):
         csv_file = open('%srun-%s.csv' % (csv_dir,
                                           dt.datetime.now().strftime('%Y-%m-%d %H-%M-%S')), 'w')
         results.to_csv(csv_file)
-    # writer = csv.writer(csv_file)
-    # writer.writerow(['Dates']+back_data['DAILY_PNL'].index.format())
-    # writer.writerow(['Daily Pnl']+daily_return.sum(axis=1).values.tolist())
-    # writer.writerow(['Total PnL']+total_return.sum(axis=1).values.tolist())
-    # writer.writerow(['Funds']+back_data['FUNDS'].values.tolist())
-    # writer.writerow(['Portfolio Value']+back_data['VALUE'].values.tolist())
-    # for stock in back_data['DAILY_PNL'].columns.tolist():
-    #     writer.writerow(['%s Position'%stock]+back_data['POSITION'][stock].values.tolist())
-    #     writer.writerow(['%s Order'%stock]+back_data['ORDER'][stock].values.tolist())
-    #     writer.writerow(['%s Filled Order'%stock]+back_data['FILLED_ORDER'][stock].values.tolist())
-    #     writer.writerow(['%s Slippage'%stock]+back_data['SLIPPAGE'][stock].values.tolist())
-    #     writer.writerow(['%s PnL'%stock]+back_data['DAILY_PNL'][stock].values.tolist())
     csv_file.close()
 
 
-def writejson(back_data, budget, baseline_data, base_index):
+def writejson(back_data, budget, baseline_data, base_index, rolling_window=None, stats=None, compact=False, fields=None, every=1, precision=None, binary=False, freq=DAILY):
+    ''' results as a dict ready for json.dumps
+    Args:
+        rolling_window: adds rolling stats of the total portfolio over that many dates
+        stats: metrics already computed for back_data, computed here if None
+        compact, fields, every, precision, binary: see compact_json
+        freq: bar length of back_data, stats are annualized over its periods_per_year
+    '''
+    if compact:
+        return compact_json(back_data, budget, baseline_data, base_index, rolling_window, stats, fields, every, precision, binary, freq)
 
     daily_return = back_data['DAILY_PNL'] / budget
     total_return = back_data['TOTAL_PNL'] / budget
-    stats = metrics(daily_return, total_return, baseline_data, base_index)
+    if stats is None:
+        stats = metrics(daily_return, total_return, baseline_data, base_index, freq)
     # multiply by 100 for readability purposes
     daily_return_percent = daily_return * 100
     total_return_percent = total_return * 100
@@ -314,11 +882,96 @@ def writejson(back_data, budget, baseline_data, base_index):
          'stocks': back_data['DAILY_PNL'].columns.tolist(),
          'stock_pnl': daily_return_percent.values.tolist(),
          'stock_position': back_data['POSITION'].values.tolist(),
-         'metrics': stats.keys(),
-         'metrics_values': stats.values()}
+         'metrics': list(stats.keys()),
+         'metrics_values': list(stats.values())}
+    if rolling_window:
+        # rolling stats of the total portfolio, e.g. d['rolling_sharpe']
+        base_return = baseline_data['DAILY_PNL'] if base_index else None
+        rolling = rolling_metrics(daily_return.sum(axis=1), rolling_window, base_return, freq)
+        d['rolling_window'] = rolling_window
+        for x in rolling:
+            # None for the dates before a full window, NaN is not valid json
+            d[x.lower().replace(' ', '_')] = json_array(rolling[x].values)
+    return d
+
+
+def compact_json(back_data, budget, baseline_data, base_index, rolling_window=None, stats=None, fields=None, every=1, precision=None, binary=False, freq=DAILY):
+    ''' column oriented version of writejson for serving many or large results
+    stock_pnl and stock_position hold one list per stock, in the order of stocks, and metrics is a dict.
+    Args:
+        fields: names of the entries to include, all by default. Metrics are only computed when asked for
+        every: keeps one date in every, with daily pnl summed over the dates dropped
+            and everything else taken on the date kept
+        precision: number of decimals floats are rounded to
+        binary: encodes arrays as {'dtype', 'shape', 'data'} with data the base64 of their
+            little-endian bytes, float32 for floats
+    '''
+    def wanted(field):
+        return fields is None or field in fields
+
+    dates = back_data['DAILY_PNL'].index
+    starts = np.arange(0, dates.size, every)
+    last = np.minimum(starts + every, dates.size) - 1
+    daily_pnl = back_data['DAILY_PNL'].values.astype(float) * 100 / budget
+    if every > 1:
+        daily_pnl = np.add.reduceat(daily_pnl, starts, axis=0)
+    total_pnl = back_data['TOTAL_PNL'].values[last].astype(float) * 100 / budget
+
+    d = {'format': 'columns', 'every': every}
+    if wanted('dates'):
+        # as writejson, with the time of day unless every date is at midnight
+        d['dates'] = dates[last].format()
+    if wanted('stocks'):
+        d['stocks'] = back_data['DAILY_PNL'].columns.tolist()
+    if wanted('daily_pnl'):
+        d['daily_pnl'] = json_array(daily_pnl.sum(axis=1), precision, binary)
+    if wanted('total_pnl'):
+        d['total_pnl'] = json_array(total_pnl.sum(axis=1), precision, binary)
+    if wanted('stock_pnl'):
+        d['stock_pnl'] = json_array(daily_pnl.T, precision, binary)
+    if wanted('stock_position'):
+        d['stock_position'] = json_array(back_data['POSITION'].values[last].T, precision, binary)
+    if wanted('metrics'):
+        if stats is None:
+            stats = metrics(back_data['DAILY_PNL'] / budget, back_data['TOTAL_PNL'] / budget, baseline_data, base_index, freq)
+        d['metrics'] = dict((x, float(stats[x])) for x in stats)
+    if rolling_window and (fields is None or any(f.startswith('rolling_') for f in fields)):
+        base_return = baseline_data['DAILY_PNL'] if base_index else None
+        rolling = rolling_metrics(back_data['DAILY_PNL'].sum(axis=1) / budget, rolling_window, base_return, freq)
+        d['rolling_window'] = rolling_window
+        for x in rolling:
+            if wanted(x.lower().replace(' ', '_')):
+                d[x.lower().replace(' ', '_')] = json_array(rolling[x].values[last], precision, binary)
     return d
 
 
+def json_array(values, precision=None, binary=False):
+    ''' values as (nested) lists, NaN as None, or with binary as a dict of dtype, shape and base64 data '''
+    values = np.asarray(values)
+    is_float = values.dtype.kind == 'f'
+    if is_float and precision is not None:
+        values = np.round(values, precision)
+    if binary:
+        if is_float:
+            values = values.astype('<f4')
+        elif values.size == 0 or (values.min() >= -2 ** 31 and values.max() < 2 ** 31):
+            values = values.astype('<i4')
+        else:
+            values = values.astype('<i8')
+        return {'dtype': 'float32' if is_float else values.dtype.name,
+                'shape': list(values.shape),
+                'data': base64.b64encode(np.ascontiguousarray(values).tobytes()).decode('ascii')}
+    if is_float and np.isnan(values).any():
+        return np.where(np.isnan(values), None, values).tolist()
+    return values.tolist()
+
+
+def loadgui(back_data, exchange, base_index, budget, logger, freq=DAILY):
+    # matplotlib and Tk are only imported once there is something to show
+    from auquanToolbox import resultviewer
+    return resultviewer.loadgui(back_data, exchange, base_index, budget, logger, freq)
+
+
 def updateCheck():
     ''' checks for new version of toolbox
     Returns:
@@ -328,7 +981,7 @@ def updateCheck():
 
     from auquanToolbox.version import __version__
     try:
-        toolboxJson = urllib2.urlopen(
+        toolboxJson = urlopen(
             'https://pypi.python.org/pypi/auquanToolbox/json')
     except:
         return False
@@ -0,0 +1,64 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import numpy as np
+import pandas as pd
+from auquanToolbox.engine import DAILY, bar_end
+
+__all__ = ['TradingCalendar']
+
+
+class TradingCalendar(object):
+    ''' integer positions of the tradable dates of a date_range returned by load_data
+
+    Built once per data load, a calendar serves every run over that data, whatever the
+    exchange or the date_start and date_end of the run: bars(date_start, date_end) is a
+    couple of binary searches instead of a date lookup per trading date.
+    Daily, business days missing from date_range are holidays, logged by bars.
+    '''
+
+    def __init__(self, date_range, freq=DAILY):
+        self.dates = date_range
+        self.freq = freq
+        if freq == DAILY and date_range.size > 0:
+            # position in date_range of every business day it spans, -1 on holidays
+            self.business_days = pd.bdate_range(date_range[0].normalize(), date_range[-1])
+            self.positions = date_range.get_indexer(self.business_days)
+        else:
+            self.business_days = pd.DatetimeIndex([])
+            self.positions = np.array([], dtype=np.int64)
+
+    def __len__(self):
+        return self.dates.size
+
+    def matches(self, date_range):
+        return self.dates is date_range or self.dates.equals(date_range)
+
+    def position(self, date):
+        ''' position of date in the calendar, KeyError if it is not a trading date '''
+        return self.dates.get_loc(pd.to_datetime(date))
+
+    def bars(self, date_start, date_end, logger=None):
+        ''' positions of the bars traded from date_start to date_end, ascending.
+        Daily, every business day in between that is not a trading date is logged as a holiday.
+        Other frequencies trade every bar in between, a date_end without a time of day includes all its bars
+        '''
+        date_start = pd.to_datetime(date_start)
+        if self.freq != DAILY:
+            (first, last) = self.dates.slice_locs(date_start, bar_end(date_end, self.freq))
+            return np.arange(first, last)
+
+        date_end = pd.to_datetime(date_end)
+        first = self.business_days.searchsorted(date_start)
+        last = self.business_days.searchsorted(date_end, side='right')
+        positions = self.positions[first:last]
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        if not hasattr(logger, 'isEnabledFor') or logger.isEnabledFor(logging.INFO):
+            # business days of the run outside the calendar have no data either
+            holidays = pd.bdate_range(date_start, date_end)
+            if self.business_days.size > 0:
+                outside = (holidays < self.business_days[0]) | (holidays > self.business_days[-1])
+                holidays = holidays[outside].append(self.business_days[first:last][positions < 0]).sort_values()
+            for date in holidays:
+                logger.info(date.strftime('Trading date is a Holiday or data not present :%d %b %Y'))
+        return positions[positions >= 0]
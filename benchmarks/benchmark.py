@@ -0,0 +1,213 @@
+''' Benchmarks of the backtest pipeline on synthetic data, no download needed.
+
+    python benchmarks/benchmark.py --output results.json
+    python benchmarks/benchmark.py --sizes 5 100 --years 1 --compare results.json
+
+Every benchmark keeps the best wall time of --repeat runs, then runs once more
+under tracemalloc for its peak memory. Files written by writecsv and writeresult go to a
+temporary directory that is removed afterwards.
+'''
+from __future__ import absolute_import, division, print_function, unicode_literals
+import argparse
+import cProfile
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+import warnings
+import numpy as np
+import pandas as pd
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from auquanToolbox.version import __version__
+from auquanToolbox.dataloader import load_data
+from auquanToolbox.toolbox import run_backtest, getquantity, execute_order, getquantity_array, execute_order_array, writecsv, writejson
+from auquanToolbox.metrics import metrics, baseline
+from auquanToolbox.resultfile import writeresult
+
+EXCHANGE = 'bench'
+BASE_INDEX = 'BASE'
+DATE_START = '2012-01-02'
+LOOKBACK = 20
+BUDGET = 1000000
+
+
+def trading_strategy(lookback_data):
+    close = lookback_data['CLOSE']
+    change = close.iloc[-1] / close.iloc[0] - 1
+    order = pd.DataFrame(0, index=close.columns, columns=['SIGNAL', 'WEIGHTS', 'PRICE'])
+    order['SIGNAL'] = np.sign(change).astype(int)
+    order['WEIGHTS'] = 1.0 / len(order)
+    return order
+
+
+def write_base_index(date_start, date_end):
+    ''' random walk csv of BASE_INDEX covering date_start to date_end, newest date first like the downloaded data '''
+    dates = pd.bdate_range(pd.to_datetime(date_start) - pd.DateOffset(years=1), date_end)[::-1]
+    close = 100 * np.exp(np.cumsum(np.random.normal(0, 0.01, dates.size)))
+    csv = pd.DataFrame({'open': close * 0.999, 'close': close, 'high': close * 1.01, 'low': close * 0.99,
+                        'volume': 1000000}, index=pd.Index(dates, name='date'),
+                       columns=['open', 'close', 'high', 'low', 'volume'])
+    dir_name = '%s/historicalData/' % EXCHANGE
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    csv.to_csv('%s%s.csv' % (dir_name, BASE_INDEX.lower()))
+
+
+def measure(function, repeat, number=1, profile_file=None):
+    ''' best wall time in seconds of number calls of function over repeat runs, and peak memory in MB '''
+    times = []
+    for i in range(repeat):
+        start = timeit.default_timer()
+        for j in range(number):
+            function()
+        times.append(timeit.default_timer() - start)
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    if profile_file is not None:
+        profile = cProfile.Profile()
+        profile.runcall(function)
+        profile.dump_stats(profile_file)
+    return min(times), peak
+
+
+def run_case(markets, years, repeat, logger, profile_dir=None, skip=()):
+    ''' benchmarks of every stage for one universe size and date span, except those named in skip '''
+    date_end = (pd.to_datetime(DATE_START) + pd.DateOffset(years=years) - pd.DateOffset(days=1)).strftime('%Y-%m-%d')
+    market_names = ['M%04d' % i for i in range(markets)]
+    write_base_index(DATE_START, date_end)
+    np.random.seed(0)
+    (back_data, date_range) = load_data(EXCHANGE, list(market_names), DATE_START, date_end, LOOKBACK, BUDGET, logger, random=True)
+    stages = []
+
+    def add(name, function, number=1):
+        if name in skip:
+            return
+        profile_file = None
+        if profile_dir is not None:
+            profile_file = os.path.join(profile_dir, '%s-%d-%dy.prof' % (name.replace(' ', '_'), markets, years))
+        (wall_time, peak_memory) = measure(function, repeat, number, profile_file)
+        stages.append({'benchmark': name, 'markets': markets, 'years': years, 'dates': int(date_range.size),
+                       'number': number, 'wall_time': wall_time, 'peak_memory': peak_memory})
+        print('%-22s %4d markets %2d years: %10.6fs' % (name, markets, years, wall_time))
+
+    add('load_data', lambda: load_data(EXCHANGE, list(market_names), DATE_START, date_end, LOOKBACK, BUDGET, logger, random=True))
+    result = {}
+
+    def backtest_numpy():
+        result.update(run_backtest(back_data, date_range, trading_strategy, DATE_START, date_end, LOOKBACK, BUDGET, logger, engine='numpy'))
+
+    add('backtest numpy', backtest_numpy)
+    if len(result) == 0:
+        # the later stages need a result even when the loop itself is skipped
+        backtest_numpy()
+    add('backtest pandas', lambda: run_backtest(back_data, date_range, trading_strategy, DATE_START, date_end, LOOKBACK, BUDGET, logger, engine='pandas'))
+
+    # sizing and execution of a single day, called once per trading date by the loops
+    order = trading_strategy({'CLOSE': back_data['CLOSE'].iloc[:LOOKBACK]})
+    price = back_data['OPEN'].iloc[LOOKBACK].astype(float)
+    slippage = (back_data['HIGH'].iloc[LOOKBACK - 1] - back_data['LOW'].iloc[LOOKBACK - 1]) * 0.05
+    position = pd.Series(0, index=price.index)
+    order['QUANTITY'] = getquantity(order, price, slippage, BUDGET, position, logger)
+    add('getquantity', lambda: getquantity(order, price, slippage, BUDGET, position, logger), number=100)
+    add('execute_order', lambda: execute_order(order, position, slippage, price, BUDGET, 0, logger, True), number=100)
+    arrays = [order['SIGNAL'].values.astype(float), order['WEIGHTS'].values, price.values, slippage.values.astype(float), position.values]
+    quantity = getquantity_array(arrays[0], arrays[1], arrays[2], arrays[3], BUDGET, arrays[4])
+    add('getquantity_array', lambda: getquantity_array(arrays[0], arrays[1], arrays[2], arrays[3], BUDGET, arrays[4]), number=100)
+    add('execute_order_array', lambda: execute_order_array(quantity, np.zeros(markets), arrays[4], arrays[3], arrays[2], BUDGET, 0, True), number=100)
+
+    # baseline is memoized, so the cache is emptied to time the first call of a run
+    baseline_module = sys.modules[baseline.__module__]
+
+    def cold_baseline():
+        baseline_module._baseline_cache.clear()
+        baseline_module._baseline_csv.clear()
+        return baseline(EXCHANGE, BASE_INDEX, result['DAILY_PNL'].index, logger)
+
+    add('baseline', cold_baseline)
+    baseline_data = baseline(EXCHANGE, BASE_INDEX, result['DAILY_PNL'].index, logger)
+    add('metrics', lambda: metrics(result['DAILY_PNL'] / BUDGET, result['TOTAL_PNL'] / BUDGET, baseline_data, BASE_INDEX))
+    add('writecsv', lambda: writecsv(result, BUDGET))
+    add('writeresult', lambda: writeresult(result, BUDGET, file_name='runLogs/benchmark.npz'))
+    add('writejson', lambda: writejson(result, BUDGET, baseline_data, BASE_INDEX))
+    return stages
+
+
+def compare(results, previous):
+    ''' prints the wall time of every benchmark against the same benchmark in previous results '''
+    before = dict(((r['benchmark'], r['markets'], r['years']), r['wall_time']) for r in previous['results'])
+    print('%-22s %7s %5s %12s %12s %7s' % ('benchmark', 'markets', 'years', 'before', 'now', 'ratio'))
+    for r in results:
+        key = (r['benchmark'], r['markets'], r['years'])
+        if key in before:
+            print('%-22s %7d %5d %12.6f %12.6f %7.2f' % (key + (before[key], r['wall_time'], r['wall_time'] / before[key])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the auquanToolbox backtest pipeline on synthetic data')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 100, 900], help='numbers of markets')
+    parser.add_argument('--years', type=int, nargs='+', default=[1, 2], help='lengths of the backtest in years')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best one is kept')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file the results are written to')
+    parser.add_argument('--compare', help='JSON file of earlier results to compare against')
+    parser.add_argument('--profile', help='directory to write a cProfile .prof file per benchmark to')
+    parser.add_argument('--skip', nargs='+', default=[],
+                        help='benchmarks to leave out, e.g. "backtest pandas" which is slow on large universes')
+    args = parser.parse_args()
+
+    # the run log of every backtest is not part of what is measured
+    logger = logging.getLogger('benchmark')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    warnings.simplefilter('ignore')
+    output = os.path.abspath(args.output)
+    profile_dir = os.path.abspath(args.profile) if args.profile else None
+    if profile_dir is not None and not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    # synthetic data and files written by writecsv stay out of the current directory
+    cwd = os.getcwd()
+    dir_name = tempfile.mkdtemp(prefix='auquan-benchmark-')
+    results = []
+    try:
+        os.chdir(dir_name)
+        # writecsv writes next to the run logs
+        os.makedirs('runLogs')
+        for markets in args.sizes:
+            for years in args.years:
+                results += run_case(markets, years, args.repeat, logger, profile_dir, args.skip)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(dir_name, ignore_errors=True)
+
+    report = {'version': __version__, 'python': platform.python_version(), 'numpy': np.__version__,
+              'pandas': pd.__version__, 'platform': platform.platform(),
+              'date': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Results written to %s' % output)
+    if previous is not None:
+        compare(results, previous)
+
+
+if __name__ == '__main__':
+    main()
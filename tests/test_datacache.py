@@ -0,0 +1,69 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from auquanToolbox.dataloader import load_data
+
+EXCHANGE = 'mixed'
+DATE_START = '2016-02-01'
+DATE_END = '2016-03-04'
+LOOKBACK = 5
+BUDGET = 1000000
+
+logger = logging.getLogger(__name__)
+
+
+def write_csv(market, columns):
+    dates = pd.bdate_range('2015-12-01', '2016-03-31')
+    np.random.seed(len(market) + len(columns))
+    csv = pd.DataFrame(np.random.uniform(10, 50, size=(dates.size, len(columns))), index=dates, columns=columns)
+    csv.index.name = 'date'
+    # newest first, as the downloaded files are
+    csv.iloc[::-1].to_csv('%s/historicalData/%s.csv' % (EXCHANGE, market.lower()))
+
+
+@pytest.fixture
+def exchange(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('%s/historicalData' % EXCHANGE)
+    with open('%s/%s.txt' % (EXCHANGE, EXCHANGE), 'w') as f:
+        f.write('AAA\nBBB\nDDD\n')
+    columns = ['open', 'close', 'high', 'low', 'volume']
+    write_csv('AAA', columns)
+    write_csv('BBB', columns)
+    # one market with a column the others don't have
+    write_csv('DDD', columns + ['adj close'])
+
+
+def load(markets, **kwargs):
+    return load_data(EXCHANGE, list(markets), DATE_START, DATE_END, LOOKBACK, BUDGET, logger, **kwargs)
+
+
+def assert_same(result, expected):
+    assert sorted(result) == sorted(expected)
+    for feature in expected:
+        assert result[feature].index.equals(expected[feature].index), feature
+        np.testing.assert_array_equal(np.asarray(result[feature].values, dtype=float),
+                                      np.asarray(expected[feature].values, dtype=float), err_msg=feature)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_cache_keeps_columns_of_each_market(exchange, stream):
+    # the cache of the exchange holds ADJ CLOSE once DDD is read through it
+    load(['DDD'], use_cache=True, state=False)
+    (expected, expected_range) = load(['AAA', 'BBB'], state=False)
+    (back_data, date_range) = load(['AAA', 'BBB'], use_cache=True, state=False, stream=stream)
+    assert expected_range.size > 0
+    assert date_range.equals(expected_range)
+    assert 'ADJ CLOSE' not in back_data
+    assert_same(back_data, expected)
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_cache_matches_csv_with_mixed_columns(exchange, stream):
+    (expected, expected_range) = load(['AAA', 'DDD'], state=False)
+    (back_data, date_range) = load(['AAA', 'DDD'], use_cache=True, state=False, stream=stream)
+    assert date_range.equals(expected_range)
+    assert_same(back_data, expected)
@@ -0,0 +1,108 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import os
+import threading
+import pytest
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+from auquanToolbox.downloader import fetch, bulk_download, write_atomic
+
+BODY = b'date,open,close,high,low,volume\n2016-01-04,1,2,3,0.5,100\n'
+
+logger = logging.getLogger(__name__)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    # kept-alive connections each hold a thread
+    daemon_threads = True
+
+
+class StandIn(BaseHTTPRequestHandler):
+    ''' answers every path with BODY, except that paths starting with /fail-<n>/ first answer
+    n times with a 503, and paths starting with /truncate-<n>/ first n times stop halfway through the body
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.client_address, self.path))
+            count = sum(1 for (address, path) in server.requests if path == self.path)
+        kind = self.path.split('/')[1]
+        if kind.startswith('missing'):
+            self.send_error(404)
+        elif kind.startswith('fail-') and count <= int(kind[5:]):
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif kind.startswith('truncate-') and count <= int(kind[9:]):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY[:len(BODY) // 2])
+            self.close_connection = True
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = Server(('127.0.0.1', 0), StandIn)
+    server.lock = threading.Lock()
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_retries_server_errors(server):
+    assert fetch(server.url + '/fail-2/a.csv', retries=3, backoff=0) == BODY
+    assert len(server.requests) == 3
+    with pytest.raises(IOError):
+        fetch(server.url + '/fail-5/a.csv', retries=2, backoff=0)
+
+
+def test_fetch_retries_truncated_body(server):
+    assert fetch(server.url + '/truncate-1/a.csv', retries=3, backoff=0) == BODY
+    assert len(server.requests) == 2
+
+
+def test_fetch_keeps_connection_open(server):
+    for i in range(3):
+        assert fetch(server.url + '/ok/%d.csv' % i, backoff=0) == BODY
+    assert fetch(server.url + '/missing/a.csv', backoff=0) is None
+    assert len(set(address for (address, path) in server.requests)) == 1
+
+
+def test_bulk_download(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    base_url = server.url + '/fail-1'
+    not_found = bulk_download('test', ['AAA', 'BBB'], logger, workers=2, backoff=0, base_url=base_url)
+    assert not_found == []
+    assert sorted(os.listdir('test/historicalData')) == ['aaa.csv', 'bbb.csv']
+    with open('test/historicalData/aaa.csv', 'rb') as f:
+        assert f.read() == BODY
+    assert bulk_download('test', ['CCC'], logger, backoff=0, base_url=server.url + '/missing') == ['CCC']
+
+
+def test_write_atomic_replaces_file(tmp_path):
+    file_name = str(tmp_path / 'a.csv')
+    write_atomic(file_name, b'old')
+    write_atomic(file_name, BODY)
+    with open(file_name, 'rb') as f:
+        assert f.read() == BODY
+    assert os.listdir(str(tmp_path)) == ['a.csv']
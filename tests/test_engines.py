@@ -0,0 +1,85 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+import numpy as np
+import pandas as pd
+import pytest
+from auquanToolbox.dataloader import load_data
+from auquanToolbox.toolbox import run_backtest, backtest_vectorized
+
+MARKETS = ['A', 'B', 'C', 'D', 'E']
+DATE_START = '2016-01-04'
+DATE_END = '2016-06-30'
+LOOKBACK = 10
+BUDGET = 1000000
+
+logger = logging.getLogger(__name__)
+
+
+def random_data():
+    np.random.seed(0)
+    return load_data('test', list(MARKETS), DATE_START, DATE_END, LOOKBACK, BUDGET, logger, random=True)
+
+
+def trading_strategy(lookback_data):
+    close = lookback_data['CLOSE']
+    change = close.iloc[-1] / close.iloc[0] - 1
+    order = pd.DataFrame(0, index=close.columns, columns=['SIGNAL', 'WEIGHTS', 'PRICE'])
+    order['SIGNAL'] = np.sign(change).astype(int)
+    order['WEIGHTS'] = np.abs(change) / np.abs(change).sum()
+    # a limit order on every other market
+    order['PRICE'] = np.where(np.arange(len(order)) % 2 == 0, close.iloc[-1], 0)
+    return order
+
+
+def assert_same(result, expected):
+    assert sorted(result) == sorted(expected)
+    for feature in expected:
+        assert result[feature].index.equals(expected[feature].index), feature
+        np.testing.assert_allclose(np.asarray(result[feature], dtype=float), np.asarray(expected[feature], dtype=float),
+                                   rtol=1e-9, atol=1e-6, err_msg=feature)
+
+
+@pytest.fixture(scope='module')
+def pandas_result():
+    (back_data, date_range) = random_data()
+    return run_backtest(back_data, date_range, trading_strategy, DATE_START, DATE_END, LOOKBACK, BUDGET, logger, engine='pandas')
+
+
+def test_numpy_engine_matches_pandas(pandas_result):
+    (back_data, date_range) = random_data()
+    result = run_backtest(back_data, date_range, trading_strategy, DATE_START, DATE_END, LOOKBACK, BUDGET, logger, engine='numpy')
+    assert (pandas_result['POSITION'] != 0).values.any()
+    assert_same(result, pandas_result)
+
+
+def test_chunked_numpy_engine_matches_pandas(pandas_result):
+    (back_data, date_range) = random_data()
+    result = run_backtest(back_data, date_range, trading_strategy, DATE_START, DATE_END, LOOKBACK, BUDGET, logger,
+                          engine='numpy', chunk_size=7)
+    assert_same(result, pandas_result)
+
+
+def test_vectorized_matches_pandas(pandas_result):
+    (back_data, date_range) = random_data()
+    # the orders trading_strategy places on every trading date, precomputed
+    days = date_range[(date_range >= pd.to_datetime(DATE_START)) & (date_range <= pd.to_datetime(DATE_END))]
+    orders = {}
+    for date in days:
+        end = date_range.get_loc(date)
+        orders[date] = trading_strategy({'CLOSE': back_data['CLOSE'].iloc[max(end - LOOKBACK, 0):end]})
+    signal = pd.DataFrame(dict((d, o['SIGNAL']) for d, o in orders.items())).T
+    weights = pd.DataFrame(dict((d, o['WEIGHTS']) for d, o in orders.items())).T
+    price = pd.DataFrame(dict((d, o['PRICE']) for d, o in orders.items())).T
+    result = backtest_vectorized(back_data, date_range, signal, weights, price, DATE_START, DATE_END, BUDGET, logger=logger)
+    assert_same(result, pandas_result)
+
+
+@pytest.mark.parametrize('engine', ['numpy', 'pandas'])
+def test_order_missing_markets_raises(engine):
+    (back_data, date_range) = random_data()
+
+    def partial_order(lookback_data):
+        return trading_strategy(lookback_data).iloc[:2]
+
+    with pytest.raises(AssertionError):
+        run_backtest(back_data, date_range, partial_order, DATE_START, DATE_END, LOOKBACK, BUDGET, logger, engine=engine)
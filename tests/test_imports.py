@@ -0,0 +1,29 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def imported_modules(statement):
+    ''' modules loaded by a fresh interpreter after running statement '''
+    code = 'import sys; %s; print("\\n".join(sorted(sys.modules)))' % statement
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return output.decode('utf-8').split()
+
+
+def test_import_does_not_load_plotting():
+    modules = imported_modules('import auquanToolbox')
+    assert 'auquanToolbox' in modules
+    for module in ['matplotlib', 'matplotlib.pyplot', 'tkinter', 'Tkinter']:
+        assert module not in modules
+
+
+def test_submodules_are_not_hidden_by_functions():
+    import auquanToolbox
+    assert callable(auquanToolbox.sweep)
+    assert callable(auquanToolbox.sweeps.walk_forward)
+    assert callable(auquanToolbox.drawdown)
+    assert callable(auquanToolbox.drawdowns.drawdown_stats)
+    assert not hasattr(auquanToolbox, 'cpu_count')
@@ -0,0 +1,70 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.testing import assert_allclose
+from auquanToolbox.metrics import metrics, rolling_metrics, periods_per_year, OnlineMetrics
+
+
+def returns(freq, size=200, seed=0):
+    np.random.seed(seed)
+    index = pd.date_range('2017-03-01 09:30', periods=size, freq=freq)
+    daily_pnl = pd.DataFrame(np.random.normal(0.0005, 0.01, size=(size, 3)), index=index)
+    return daily_pnl, daily_pnl.cumsum()
+
+
+def online_stats(daily_return, base_return=None, freq='B'):
+    online = OnlineMetrics(freq)
+    for i, r in enumerate(daily_return):
+        online.update(r, None if base_return is None else base_return[i])
+    return online.stats()
+
+
+def test_periods_per_year():
+    assert periods_per_year('B') == 252
+    assert periods_per_year('H') == 252 * 6.5
+    assert periods_per_year('30min') == 252 * 13
+    assert periods_per_year('W') == 52
+
+
+@pytest.mark.parametrize('freq', ['B', 'H', '5min'])
+def test_stats_are_annualized_over_bars_of_freq(freq):
+    (daily_pnl, total_pnl) = returns(freq)
+    stats = metrics(daily_pnl, total_pnl, {}, None, freq)
+    daily_return = daily_pnl.sum(axis=1)
+    periods = periods_per_year(freq)
+    assert_allclose(stats['Annual Vol'], np.sqrt(periods) * np.std(daily_return))
+    assert_allclose(stats['Annual Return'], (1 + daily_return.sum())**(periods / daily_return.size) - 1)
+
+    assert_allclose(online_stats(daily_return.values, freq=freq)['Sharpe Ratio'], stats['Sharpe Ratio'])
+    rolling = rolling_metrics(daily_return, daily_return.size, freq=freq)
+    assert_allclose(rolling['Rolling Vol'].iloc[-1], stats['Annual Vol'])
+
+
+def assert_same_stats(result, expected):
+    assert sorted(result) == sorted(expected)
+    for x in expected:
+        assert_allclose(result[x], expected[x], rtol=1e-9, atol=1e-12, err_msg=x)
+
+
+@pytest.mark.parametrize('series', ['random', 'zero', 'losing'])
+def test_online_metrics_match_metrics(series):
+    (daily_pnl, total_pnl) = returns('B')
+    if series == 'zero':
+        daily_pnl[:] = 0.0
+    elif series == 'losing':
+        daily_pnl[:] = -np.abs(daily_pnl.values)
+    total_pnl = daily_pnl.cumsum()
+    daily_return = daily_pnl.sum(axis=1)
+    assert_same_stats(online_stats(daily_return.values), metrics(daily_pnl, total_pnl, {}, None))
+
+
+@pytest.mark.parametrize('base', ['random', 'zero'])
+def test_online_metrics_match_metrics_with_base_index(base):
+    (daily_pnl, total_pnl) = returns('B')
+    (base_pnl, base_total) = returns('B', seed=1)
+    base_return = base_pnl.iloc[:, 0] if base == 'random' else base_pnl.iloc[:, 0] * 0
+    baseline_data = {'DAILY_PNL': base_return}
+    expected = metrics(daily_pnl, total_pnl, baseline_data, 'BASE')
+    assert ('Beta' in expected) == (base == 'random')
+    assert_same_stats(online_stats(daily_pnl.sum(axis=1).values, base_return.values), expected)
@@ -0,0 +1,40 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import logging
+import numpy as np
+import pandas as pd
+import pytest
+from auquanToolbox.dataloader import load_data
+from auquanToolbox.toolbox import run_backtest, writejson
+
+MARKETS = ['A', 'B', 'C']
+DATE_START = '2016-01-04'
+DATE_END = '2016-03-31'
+LOOKBACK = 10
+BUDGET = 1000000
+
+logger = logging.getLogger(__name__)
+
+
+def trading_strategy(lookback_data):
+    close = lookback_data['CLOSE']
+    change = close.iloc[-1] / close.iloc[0] - 1
+    order = pd.DataFrame(0, index=close.columns, columns=['SIGNAL', 'WEIGHTS', 'PRICE'])
+    order['SIGNAL'] = np.sign(change).astype(int)
+    order['WEIGHTS'] = np.abs(change) / np.abs(change).sum()
+    return order
+
+
+def reject(constant):
+    raise ValueError('%s is not valid json' % constant)
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_rolling_json_has_no_nan(compact):
+    np.random.seed(0)
+    (back_data, date_range) = load_data('test', list(MARKETS), DATE_START, DATE_END, LOOKBACK, BUDGET, logger, random=True)
+    back_data = run_backtest(back_data, date_range, trading_strategy, DATE_START, DATE_END, LOOKBACK, BUDGET, logger)
+    d = writejson(back_data, BUDGET, {}, None, rolling_window=5, compact=compact)
+    d = json.loads(json.dumps(d), parse_constant=reject)
+    assert d['rolling_vol'][0] is None
+    assert d['rolling_vol'][-1] > 0